@@ -0,0 +1,110 @@
+import asyncio, functools, threading, weakref, logging
+from concurrent.futures import ThreadPoolExecutor
+from gkbus.protocol import kwp2000
+from gkbus.protocol.kwp2000.enums import DiagnosticSession
+from gkbus.protocol.kwp2000.kwp2000_response import Kwp2000Response
+from .ecu import ECU
+from .memory import read_memory, write_memory, write_flash_plan, FlashPlan, ReadResult
+from . import logging as ecu_logging
+
+logger = logging.getLogger(__name__)
+
+# one worker per bus, so requests to the same ECU never interleave and different buses run side by side
+_executors = weakref.WeakKeyDictionary()
+_executors_lock = threading.Lock()
+
+def get_executor (bus: kwp2000.Kwp2000Protocol) -> ThreadPoolExecutor:
+	with _executors_lock:
+		if bus not in _executors:
+			_executors[bus] = ThreadPoolExecutor(max_workers=1, thread_name_prefix='bus')
+		return _executors[bus]
+
+class OperationCancelled (Exception):
+	pass
+
+class Cancellation:
+	'''
+	Progress callback handed to the blocking memory functions. Passes updates on to the
+	wrapped callback and raises OperationCancelled at the next update once cancel() was called,
+	that's the only point where an operation running in a worker thread can be stopped
+	'''
+	def __init__ (self, progress_callback=None):
+		self.progress_callback = progress_callback
+		self.event = threading.Event()
+
+	def cancel (self) -> None:
+		self.event.set()
+
+	def check (self) -> None:
+		if self.event.is_set():
+			raise OperationCancelled()
+
+	def title (self, title: str) -> None:
+		self.check()
+		if self.progress_callback:
+			self.progress_callback.title(title)
+
+	def __call__ (self, value: int) -> None:
+		self.check()
+		if self.progress_callback:
+			self.progress_callback(value)
+
+class AsyncECU:
+	'''
+	asyncio facade over an ECU. Blocking calls run on the executor of the ECU's bus.
+	Every coroutine takes a timeout (falling back to the one given here), on timeout or
+	cancellation the operation is stopped at its next progress update and the
+	next operation on the same bus only starts once it did
+	'''
+	def __init__ (self, ecu: ECU, timeout: float = None):
+		self.ecu = ecu
+		self.timeout = timeout
+		self.executor = get_executor(ecu.bus)
+
+	async def run (self, fn, *args, cancellation: Cancellation = None, timeout: float = None, **kwargs):
+		'''
+		Run fn(*args, **kwargs) on the bus executor. If cancellation is given,
+		it's passed to fn as its progress_callback
+		'''
+		if cancellation is not None:
+			kwargs['progress_callback'] = cancellation
+
+		future = asyncio.get_running_loop().run_in_executor(self.executor, functools.partial(fn, *args, **kwargs))
+		try:
+			# shielded, so the result of an operation that ignores cancel() isn't thrown away half way
+			return await asyncio.wait_for(asyncio.shield(future), timeout if timeout is not None else self.timeout)
+		except (asyncio.CancelledError, asyncio.TimeoutError):
+			if cancellation is not None:
+				cancellation.cancel()
+			# nobody awaits it anymore, OperationCancelled ending it is expected
+			future.add_done_callback(lambda x: x.cancelled() or x.exception())
+			logger.info('%s cancelled', getattr(fn, '__name__', fn))
+			raise
+
+	async def execute (self, command: kwp2000.Kwp2000Command, timeout: float = None) -> Kwp2000Response:
+		return await self.run(self.ecu.bus.execute, command, timeout=timeout)
+
+	async def read_memory (self, address_start: int, address_stop: int, progress_callback=None, timeout: float = None, **kwargs) -> ReadResult:
+		return await self.run(read_memory, self.ecu, address_start, address_stop, cancellation=Cancellation(progress_callback), timeout=timeout, **kwargs)
+
+	async def write_memory (self, payload: bytes, flash_start: int, flash_size: int, progress_callback=None, timeout: float = None, **kwargs) -> None:
+		return await self.run(write_memory, self.ecu, payload, flash_start, flash_size, cancellation=Cancellation(progress_callback), timeout=timeout, **kwargs)
+
+	async def write_flash_plan (self, plan: FlashPlan, progress_callback=None, timeout: float = None, **kwargs) -> None:
+		return await self.run(write_flash_plan, self.ecu, plan, cancellation=Cancellation(progress_callback), timeout=timeout, **kwargs)
+
+	async def fetch_identification (self, timeout: float = None) -> dict:
+		return await self.run(self.ecu.fetch_identification, timeout=timeout)
+
+	async def poll (self, timeout: float = None) -> list:
+		'''
+		One round of logger data sources, converted like the CSV logger does
+		'''
+		return await self.run(self._poll, ecu_logging.poll, timeout=timeout)
+
+	async def poll_raw (self, timeout: float = None) -> list[bytes]:
+		return await self.run(self._poll, ecu_logging.poll_raw, timeout=timeout)
+
+	def _poll (self, poll):
+		self.ecu.session.require(DiagnosticSession.DEFAULT)
+		return poll(self.ecu)
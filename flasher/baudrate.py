@@ -0,0 +1,163 @@
+import time, logging
+from dataclasses import dataclass
+from serial.tools import list_ports
+from gkbus.protocol import kwp2000
+from gkbus.hardware import TimeoutException
+from ecu_definitions import BAUDRATES, AccessLevel
+from .ecu import ECU, DesiredBaudrate, save_identification
+from .memory import default_transfer_size
+from .profile import profiles, ecu_profile_key
+
+logger = logging.getLogger(__name__)
+
+default_burst_requests = 8
+# has to be longer than the ECU's session timeout, so it falls back to 10400 baud on its own
+recovery_delay = 5.5
+
+@dataclass
+class BaudrateTrial:
+	'''
+	Result of a ReadMemoryByAddress burst at one baudrate. throughput is in bytes per second
+	'''
+	desired_baudrate: DesiredBaudrate
+	throughput: float = 0
+	errors: int = 0
+
+	def stable (self) -> bool:
+		return self.errors == 0 and self.throughput > 0
+
+def adapter_serial (port: str) -> str:
+	'''
+	USB serial number of the adapter behind the port, so the result follows
+	the adapter and not the port name. Falls back to the port name
+	'''
+	for device in list_ports.comports():
+		if device.device == port and device.serial_number:
+			return device.serial_number
+	return port
+
+def baudrate_profile_key (ecu: ECU) -> str:
+	return ecu_profile_key(ecu, 'baudrate/{}'.format(adapter_serial(ecu.bus.transport.hardware.port)))
+
+def start_session_at (bus: kwp2000.Kwp2000Protocol, desired_baudrate: DesiredBaudrate) -> None:
+	'''
+	Start the flash reprogramming session and switch to the given baudrate. If the ECU doesn't
+	answer, it might already be running at that baudrate, so it's asked again at it
+	'''
+	try:
+		bus.execute(kwp2000.commands.StartDiagnosticSession(kwp2000.enums.DiagnosticSession.FLASH_REPROGRAMMING, desired_baudrate.index))
+		bus.transport.hardware.set_baudrate(desired_baudrate.baudrate)
+	except TimeoutException:
+		bus.transport.hardware.socket.reset_input_buffer() # @todo: expose this in public gkbus api
+		bus.transport.hardware.socket.reset_output_buffer()
+		bus.transport.hardware.set_baudrate(desired_baudrate.baudrate)
+		bus.execute(kwp2000.commands.StartDiagnosticSession(kwp2000.enums.DiagnosticSession.FLASH_REPROGRAMMING, desired_baudrate.index))
+
+def ensure_keepalive (bus: kwp2000.Kwp2000Protocol) -> None:
+	'''
+	The keepalive stops after a few failures in a row and recover() stops it on purpose,
+	start it again if either happened
+	'''
+	policy = getattr(bus, 'keepalive_policy', None)
+	if policy is not None and not policy.running():
+		logger.info('Keepalive is stopped, restarting it')
+		policy.start()
+
+def try_baudrate (ecu: ECU, desired_baudrate: DesiredBaudrate, requests: int = default_burst_requests) -> BaudrateTrial:
+	'''
+	Switch to the baudrate and time a burst of ReadMemoryByAddress at the calibration zone
+	'''
+	trial = BaudrateTrial(desired_baudrate)
+	ecu.set_desired_baudrate(desired_baudrate)
+
+	try:
+		# switching restarts the session, which drops security access the calibration zone is read with
+		ecu.session.require(ecu.get_diagnostic_session_type(), access_level=AccessLevel.HYUNDAI_0x1)
+	except (kwp2000.Kwp2000NegativeResponseException, TimeoutException) as e:
+		logger.info('Baudrate %s rejected: %s', desired_baudrate.baudrate, e.__class__.__name__)
+		trial.errors += 1
+		return trial
+
+	size = default_transfer_size
+	fetched = 0
+	started = time.monotonic()
+	for _ in range(requests):
+		try:
+			fetched += len(ecu.bus.execute(kwp2000.commands.ReadMemoryByAddress(offset=ecu.get_calibration_section_address(), size=size)).get_data())
+		except (kwp2000.Kwp2000NegativeResponseException, TimeoutException):
+			trial.errors += 1
+	trial.throughput = fetched/(time.monotonic()-started)
+
+	logger.info('Baudrate %s: %.0f B/s, %s error(s)', desired_baudrate.baudrate, trial.throughput, trial.errors)
+	return trial
+
+def recover (ecu: ECU) -> None:
+	'''
+	Get back to 10400 baud after a failed trial: let the ECU's session time out,
+	then start communication, the diagnostic session and security access again
+	'''
+	bus = ecu.bus
+	policy = getattr(bus, 'keepalive_policy', None)
+	if policy is not None:
+		policy.stop()
+	bus.transport.hardware.set_baudrate(BAUDRATES[0x01])
+	time.sleep(recovery_delay)
+
+	bus.init(kwp2000.commands.StartCommunication())
+	if policy is not None:
+		policy.start()
+	ecu.set_desired_baudrate(DesiredBaudrate(index=None, baudrate=BAUDRATES[0x01]))
+	ecu.session.invalidate()
+	ecu.session.require(ecu.get_diagnostic_session_type(), access_level=AccessLevel.HYUNDAI_0x1)
+
+def negotiate_baudrate (ecu: ECU, requests: int = default_burst_requests, reprobe: bool = False) -> DesiredBaudrate:
+	'''
+	Switch to the baudrate with the highest measured throughput among the ones that survive
+	a burst of reads without errors. Every rate is tried, a faster line doesn't help when the ECU
+	is slow to answer at it. The winner is remembered for this adapter and ECU type and with the
+	car's identification, next time the remembered rate is kept without measuring the others
+	if it's still stable
+	'''
+	if ecu.get_protocol() != 'kline':
+		logger.info('Baudrate negotiation is only done on K-Line')
+		return ecu.get_desired_baudrate()
+
+	key = baudrate_profile_key(ecu)
+	candidates = sorted(BAUDRATES.items(), key=lambda x: x[1], reverse=True)
+
+	remembered = profiles.get(key)
+	if remembered in BAUDRATES and not reprobe:
+		candidates = [(remembered, BAUDRATES[remembered])] + [x for x in candidates if x[0] != remembered]
+
+	best = None
+	try:
+		for index, baudrate in candidates:
+			desired_baudrate = DesiredBaudrate(index=index, baudrate=baudrate)
+			if index == 0x01 and ecu.session.baudrate_index is None:
+				# that's where the session started, measure it without switching
+				desired_baudrate = ecu.get_desired_baudrate()
+
+			trial = try_baudrate(ecu, desired_baudrate, requests=requests)
+			if not trial.stable():
+				recover(ecu)
+				continue
+
+			if best is None or trial.throughput > best.throughput:
+				best = trial
+			if index == remembered and not reprobe:
+				break
+
+		if best is None:
+			return ecu.get_desired_baudrate()
+
+		if best.desired_baudrate.index != ecu.session.baudrate_index:
+			ecu.set_desired_baudrate(best.desired_baudrate)
+			ecu.session.require(ecu.get_diagnostic_session_type(), access_level=AccessLevel.HYUNDAI_0x1)
+	finally:
+		ensure_keepalive(ecu.bus)
+
+	index = best.desired_baudrate.index or 0x01
+	profiles.set(key, index)
+	save_identification(ecu.get_fingerprint(), baudrate=index)
+	logger.info('Using %s baud, %.0f B/s', best.desired_baudrate.baudrate, best.throughput)
+	return best.desired_baudrate
@@ -0,0 +1,106 @@
+import os, csv, queue, threading, time, logging
+
+logger = logging.getLogger(__name__)
+
+default_max_rows = 1024
+default_fsync_interval = 1
+
+class QueuedWriter:
+	'''
+	Writes items to an open file from a background thread. At most max_items items wait
+	in memory, put() blocks once that many are queued. Whatever is queued is written in
+	batches, flushed and fsynced at least every fsync_interval seconds and on close(), which
+	also happens when leaving the with block, whatever the reason. Subclasses open the file
+	and implement write_items()
+	'''
+	def __init__ (self, file, max_items: int = default_max_rows, fsync_interval: float = default_fsync_interval):
+		self.file = file
+		self.fsync_interval = fsync_interval
+		self.items = queue.Queue(maxsize=max_items)
+		self.written = 0
+		self.error = None
+
+		self.thread = threading.Thread(target=self._run, name='{} writer'.format(self.__class__.__name__), daemon=True)
+		self.thread.start()
+
+	def write_items (self, items: list) -> None:
+		raise NotImplementedError
+
+	def _run (self) -> None:
+		synced = time.monotonic()
+		try:
+			running = True
+			while running:
+				try:
+					batch = [self.items.get(timeout=self.fsync_interval)]
+				except queue.Empty:
+					batch = []
+
+				# take whatever else is already waiting, it's written in one go
+				while batch and batch[-1] is not None and len(batch) < self.items.maxsize and not self.items.empty():
+					batch.append(self.items.get_nowait())
+
+				if batch and batch[-1] is None:
+					batch.pop()
+					running = False
+				if batch:
+					self.write_items(batch)
+					self.written += len(batch)
+
+				if time.monotonic()-synced >= self.fsync_interval:
+					self._sync()
+					synced = time.monotonic()
+		except Exception as e:
+			logger.error('Writing %s failed: %s', self.file.name, e)
+			self.error = e
+		finally:
+			# nothing's going to take items off the queue anymore, don't let put() hang on it
+			while self.error is not None and not self.items.empty():
+				self.items.get_nowait()
+
+	def _sync (self) -> None:
+		self.file.flush()
+		os.fsync(self.file.fileno())
+
+	def put (self, item) -> None:
+		if self.error is not None:
+			raise self.error
+		self.items.put(item)
+
+	def close (self) -> None:
+		if self.file.closed:
+			return
+		self.items.put(None)
+		self.thread.join()
+		try:
+			self._sync()
+		finally:
+			self.file.close()
+		if self.error is not None:
+			raise self.error
+
+	def __enter__ (self):
+		return self
+
+	def __exit__ (self, *args) -> None:
+		self.close()
+
+class StreamingCsvWriter (QueuedWriter):
+	'''
+	CSV writer whose rows are written to disk by a background thread, see QueuedWriter
+	'''
+	def __init__ (self, filename: str, max_rows: int = default_max_rows, fsync_interval: float = default_fsync_interval):
+		self.filename = filename
+		file = open(filename, 'w', newline='')
+		self.writer = csv.writer(file)
+		super().__init__(file, max_items=max_rows, fsync_interval=fsync_interval)
+
+	def write_items (self, rows: list[list]) -> None:
+		self.writer.writerows(rows)
+
+	def writerow (self, row: list) -> None:
+		self.put(list(row))
+
+	def writerows (self, rows: list[list]) -> None:
+		for row in rows:
+			self.writerow(row)
@@ -2,8 +2,12 @@ import logging
 from typing_extensions import Self
 from gkbus.protocol import kwp2000
 from gkbus.hardware import TimeoutException
+from gkbus.transport import Kwp2000OverCanTransport
 from ecu_definitions import ECU_IDENTIFICATION_TABLE, IOIdentifier, AccessLevel
 from dataclasses import dataclass
+from .retry import identification_retry
+from .profile import profiles, identification_profile_key
+from .session import SessionManager
 
 logger = logging.getLogger(__name__)
 
@@ -29,16 +33,69 @@ kwp_ecu_identification_parameters = [
 	{'value': 0x8F, 'name': 'System supplier specific'},
 ]
 
-def fetch_ecu_identification (bus):
+def fetch_ecu_identification (bus, parameters: list[int] = None):
+	'''
+	Read every known identification parameter the ECU answers to, or only the given ones
+	'''
 	values = {}
 	for parameter in kwp_ecu_identification_parameters:
+		if parameters is not None and parameter['value'] not in parameters:
+			continue
 		try:
-			value = bus.execute(kwp2000.commands.ReadEcuIdentification(parameter['value'])).get_data()
+			value = identification_retry.call(bus.execute, kwp2000.commands.ReadEcuIdentification(parameter['value'])).get_data()
 		except kwp2000.Kwp2000NegativeResponseException:
 			continue
 		values[parameter['value']] = {'name': parameter['name'], 'value': value[1:]}
 	return values
 
+def fetch_ecu_fingerprint (bus) -> str:
+	'''
+	Cheap key for the identification cache: current VIN and calibration version.
+	None if the ECU doesn't report both
+	'''
+	values = []
+	for parameter in (0x90, 0x8E):
+		try:
+			values.append(bytes(bus.execute(kwp2000.commands.ReadEcuIdentification(parameter)).get_data()[1:]).hex())
+		except (kwp2000.Kwp2000NegativeResponseException, TimeoutException):
+			return None
+	return '/'.join(values)
+
+def load_identification (fingerprint: str) -> dict:
+	'''
+	What we know about a car seen before: 'ecu' (definition name), 'baudrate' (desired baudrate index)
+	and 'identification' (same as fetch_ecu_identification returns). Empty if it's not known
+	'''
+	if not fingerprint:
+		return {}
+
+	record = profiles.get(identification_profile_key(fingerprint), {})
+	if record.get('identification') is not None:
+		record['identification'] = {
+			int(key): {'name': value['name'], 'value': bytes(value['value'])} for key, value in record['identification'].items()
+		}
+	return record
+
+def save_identification (fingerprint: str, **fields) -> None:
+	'''
+	Replace the given fields of the cached record
+	'''
+	if not fingerprint:
+		return
+
+	record = profiles.get(identification_profile_key(fingerprint), {})
+	for field, value in fields.items():
+		if field == 'identification' and value is not None:
+			value = {str(key): {'name': parameter['name'], 'value': list(parameter['value'])} for key, parameter in value.items()}
+		record[field] = value
+	profiles.set(identification_profile_key(fingerprint), record)
+
+def find_ecu_definition (name: str) -> dict:
+	for ecu_identifier in ECU_IDENTIFICATION_TABLE:
+		if ecu_identifier['ecu']['name'] == name:
+			return ecu_identifier['ecu']
+	return None
+
 def calculate_key (concat11_seed):
     key = 0x9360
     
@@ -79,25 +136,33 @@ class ECU:
 	calibration_size_bytes: int
 	program_section_address: int
 	program_section_size: int
+	read_boundaries: set[int]
 
 	bus: kwp2000.Kwp2000Protocol
 	desired_baudrate: DesiredBaudrate
+	fingerprint: str
 	diagnostic_session_type: kwp2000.enums.DiagnosticSession 
 	access_level: AccessLevel
+	session: SessionManager
 
 	def __init__ (self, 
 		name: str, 
 		eeprom_size_bytes: int,
 		bin_offset: int,
 		calibration_section_address: int, calibration_size_bytes: int,
-		program_section_address: int, program_section_size: int
+		program_section_address: int, program_section_size: int,
+		read_boundaries: list[int] = None
 		):
 		self.name = name
 		self.eeprom_size_bytes = eeprom_size_bytes
 		self.bin_offset = bin_offset
 		self.calibration_section_address, self.calibration_size_bytes = calibration_section_address, calibration_size_bytes
 		self.program_section_address, self.program_section_size = program_section_address, program_section_size
+		self.read_boundaries = set(read_boundaries or [])
 		self.desired_baudrate = DesiredBaudrate(index=None, baudrate=10400)
+		self.fingerprint = None
+		self.diagnostic_session_type = kwp2000.enums.DiagnosticSession.FLASH_REPROGRAMMING
+		self.session = SessionManager(self)
 
 	def get_name (self) -> str:
 		return self.name 
@@ -117,10 +182,29 @@ class ECU:
 	def get_program_section_size (self) -> int:
 		return self.program_section_size
 
+	def get_read_boundaries (self) -> set[int]:
+		return self.read_boundaries
+
+	def add_read_boundary (self, offset: int) -> Self:
+		'''
+		Mark an address that a single ReadMemoryByAddress can't cross, 
+		usually where eeprom pages switch
+		'''
+		self.read_boundaries.add(offset)
+		return self
+
 	def set_bus (self, bus: kwp2000.Kwp2000Protocol) -> Self:
 		self.bus = bus
 		return self
 
+	def get_protocol (self) -> str:
+		'''
+		Name of the protocol the bus is running on, same as in gkflasher.yml
+		'''
+		if isinstance(self.bus.transport, Kwp2000OverCanTransport):
+			return 'canbus'
+		return 'kline'
+
 	def get_desired_baudrate (self) -> DesiredBaudrate:
 		return self.desired_baudrate
 
@@ -131,6 +215,43 @@ class ECU:
 		self.desired_baudrate = desired_baudrate
 		return self
 
+	def get_fingerprint (self) -> str:
+		return self.fingerprint
+
+	def set_fingerprint (self, fingerprint: str) -> Self:
+		'''
+		Key for the identification cache, see fetch_ecu_fingerprint
+		'''
+		self.fingerprint = fingerprint
+		return self
+
+	def fetch_identification (self) -> dict:
+		'''
+		Same as fetch_ecu_identification, but answered from the identification cache 
+		if this car was seen before
+		'''
+		identification = load_identification(self.fingerprint).get('identification')
+		if identification is None:
+			identification = fetch_ecu_identification(self.bus)
+			save_identification(self.fingerprint, identification=identification)
+		return identification
+
+	def get_identification (self, parameter: int) -> bytes:
+		'''
+		A single ReadEcuIdentification value, from the identification cache if it's there
+		'''
+		identification = load_identification(self.fingerprint).get('identification') or {}
+		if parameter in identification:
+			return identification[parameter]['value']
+		return bytes(self.bus.execute(kwp2000.commands.ReadEcuIdentification(parameter)).get_data()[1:])
+
+	def forget_identification (self) -> None:
+		'''
+		Drop the cached identification values, they might change after flashing.
+		The ECU definition and baudrate are kept
+		'''
+		save_identification(self.fingerprint, identification=None)
+
 	def get_diagnostic_session_type (self) -> kwp2000.enums.DiagnosticSession:
 		return self.diagnostic_session_type
 
@@ -163,7 +284,7 @@ class ECU:
 	def _security_access_siemens (self) -> bool:
 		logger.info('Attempting privilege escalation via the IOCLID')
 		
-		self.bus.execute(kwp2000.commands.StartDiagnosticSession(kwp2000.enums.DiagnosticSession.DEFAULT, self.desired_baudrate.index))
+		self.session.require(kwp2000.enums.DiagnosticSession.DEFAULT)
 		
 		try:
 			self.bus.execute(
@@ -180,7 +301,7 @@ class ECU:
 		except TimeoutException:
 			logger.error('Received a timeout while trying to escalate privileges. This might indicate that something went wrong with the patch and the ECU is now being restarted by watchdog.')
 		finally:
-			self.bus.execute(kwp2000.commands.StartDiagnosticSession(self.diagnostic_session_type, self.desired_baudrate.index))
+			self.session.require(self.diagnostic_session_type)
 
 		return False
 
@@ -192,6 +313,7 @@ class ECU:
 				return False
 		
 		self.access_level = access_level
+		self.session.set_access_level(access_level)
 		return True
 
 	def get_calibration (self) -> str:
@@ -202,6 +324,25 @@ class ECU:
 		description = self.bus.execute(kwp2000.commands.ReadMemoryByAddress(offset=self.get_calibration_section_address()+0x40, size=8)).get_data()
 		return ''.join([chr(x) for x in list(description)])
 
+	def _find_readable_prefix (self, offset: int, size: int, data: bytes) -> tuple[int, bytes]:
+		'''
+		Binary search for the longest prefix of a rejected read that the ECU will return,
+		data is the first byte, already read. Returns the length of that prefix and its data
+		'''
+		readable, unreadable = 1, size
+
+		while (unreadable-readable) > 1:
+			length = (readable+unreadable)//2
+			try:
+				data = self.bus.execute(kwp2000.commands.ReadMemoryByAddress(offset=offset, size=length)).get_data()
+				readable = length
+			except kwp2000.Kwp2000NegativeResponseException as e:
+				if e.status.identifier != kwp2000.Kwp2000NegativeStatusIdentifierEnum.CANT_UPLOAD_FROM_SPECIFIED_ADDRESS.value:
+					raise
+				unreadable = length
+
+		return readable, data
+
 	def read_memory_by_address (self, offset: int, size: int) -> bytes:
 		data = bytes()
 		
@@ -216,35 +357,88 @@ class ECU:
 			if e.status.identifier == kwp2000.Kwp2000NegativeStatusIdentifierEnum.CANT_UPLOAD_FROM_SPECIFIED_ADDRESS.value:
 				if size == 1:
 					raise
-				logger.warning('Can\'t upload from %s! This might be a restricted area or more commonly, offset where eeprom pages switch. I\'m gonna try reading 1 byte at a time for the next 16 bytes', hex(offset))
-				try:
-					one_at_a_time_amount = min(16, size)
-					for x in range(one_at_a_time_amount):
-						data += self.read_memory_by_address(offset+x, size=1)
-					data += self.read_memory_by_address(offset+one_at_a_time_amount, size=size-one_at_a_time_amount)
-				except kwp2000.Kwp2000NegativeResponseException as e:
-					raise e
+				# inside a restricted area a search would only ever find nothing, a single byte tells first
+				data = self.read_memory_by_address(offset, size=1)
+				logger.warning('Can\'t upload from %s! This might be a restricted area or more commonly, offset where eeprom pages switch. Looking for the exact address', hex(offset))
+				readable, data = self._find_readable_prefix(offset, size, data)
+
+				logger.info('Found a read boundary at %s', hex(offset+readable))
+				self.add_read_boundary(offset+readable)
+				data += self.read_memory_by_address(offset+readable, size=size-readable)
 			else:
 				raise e
 		return data
 
 	def clear_adaptive_values (self):
-		self.bus.execute(kwp2000.commands.StartDiagnosticSession(kwp2000.enums.DiagnosticSession.DEFAULT, self.desired_baudrate.index))
+		# the session isn't switched back, whatever runs next asks for what it needs
+		self.session.require(kwp2000.enums.DiagnosticSession.DEFAULT)
 		self.bus.execute(kwp2000.commands.InputOutputControlByLocalIdentifier(IOIdentifier.ADAPTIVE_VALUES.value, kwp2000.enums.InputOutputControlParameter.RESET_TO_DEFAULT))
-		self.bus.execute(kwp2000.commands.StartDiagnosticSession(self.diagnostic_session_type, self.desired_baudrate.index))
 
 class ECUIdentificationException (Exception):
 	pass
 
+def build_identification_index (table: list) -> dict:
+	'''
+	Longest signature expected at every offset of the table, so each offset
+	can be read once and matched against all of its candidates
+	'''
+	index = {}
+	for ecu_identifier in table:
+		length = max(len(expected) for expected in ecu_identifier['expected'])
+		index[ecu_identifier['offset']] = max(index.get(ecu_identifier['offset'], 0), length)
+	return index
+
+identification_index = build_identification_index(ECU_IDENTIFICATION_TABLE)
+
 def identify_ecu (bus: kwp2000.Kwp2000Protocol) -> ECU:
+	'''
+	Candidates are tried in table order (more specific signatures first), 
+	but every offset is only read once, at the longest length expected there
+	'''
+	signatures = {}
+
+	def read_signature (offset: int, size: int) -> bytes:
+		if (offset, size) not in signatures:
+			try:
+				signatures[(offset, size)] = identification_retry.call(bus.execute, kwp2000.commands.ReadMemoryByAddress(offset=offset, size=size)).get_data()
+			except kwp2000.Kwp2000NegativeResponseException:
+				signatures[(offset, size)] = None
+		return signatures[(offset, size)]
+
 	for ecu_identifier in ECU_IDENTIFICATION_TABLE:
-		try:
-			result = bus.execute(kwp2000.commands.ReadMemoryByAddress(offset=ecu_identifier['offset'], size=len(ecu_identifier['expected'][0]))).get_data()
-		except kwp2000.Kwp2000NegativeResponseException:
+		offset = ecu_identifier['offset']
+		signature = read_signature(offset, identification_index[offset])
+		if signature is None and len(ecu_identifier['expected'][0]) < identification_index[offset]:
+			# the longer read might be what got rejected
+			signature = read_signature(offset, len(ecu_identifier['expected'][0]))
+		if signature is None:
 			continue
 
-		if result in ecu_identifier['expected']:
+		if any(signature.startswith(expected) for expected in ecu_identifier['expected']):
 			ecu = ECU(**ecu_identifier['ecu'])
 			ecu.set_bus(bus)
 			return ecu
 	raise ECUIdentificationException('Failed to identify ECU!')
+
+def verify_ecu (bus: kwp2000.Kwp2000Protocol, name: str) -> ECU:
+	'''
+	Check a cached identification before trusting it: read the signature of the named
+	definition once and return its ECU if it still matches, None if it doesn't
+	'''
+	for ecu_identifier in ECU_IDENTIFICATION_TABLE:
+		if ecu_identifier['ecu']['name'] != name:
+			continue
+
+		# the longest signature first, a shorter read if the ECU rejects it
+		for size in sorted({len(expected) for expected in ecu_identifier['expected']}, reverse=True):
+			try:
+				signature = identification_retry.call(bus.execute, kwp2000.commands.ReadMemoryByAddress(offset=ecu_identifier['offset'], size=size)).get_data()
+			except kwp2000.Kwp2000NegativeResponseException:
+				continue
+
+			if any(signature.startswith(expected) for expected in ecu_identifier['expected']):
+				ecu = ECU(**ecu_identifier['ecu'])
+				ecu.set_bus(bus)
+				return ecu
+			break
+	return None
@@ -0,0 +1,199 @@
+import re, sys, time, logging, threading, traceback
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Callable
+from gkbus.protocol import kwp2000
+
+logger = logging.getLogger(__name__)
+
+protocols = ['canbus', 'kline']
+# how long benches get to wind down after Ctrl+C before the fleet is left behind
+stop_timeout = 10
+
+@dataclass
+class Bench:
+	protocol: str
+	interface: str
+
+	def get_name (self) -> str:
+		return re.sub(r'[^0-9A-Za-z]+', '', self.interface.split('/')[-1]) or self.protocol
+
+@dataclass
+class BenchResult:
+	'''
+	Outcome of the job on one bench. status is done, aborted (the job returned nothing,
+	e.g. the ECU couldn't be identified, or the fleet was stopped) or failed (the job raised, error holds why,
+	a JobFailed still names the ECU). transferred counts request and response bytes that went over the bus
+	'''
+	bench: Bench
+	status: str = 'pending'
+	ecu: str = None
+	transferred: int = 0
+	elapsed: float = 0
+	error: str = None
+
+	def throughput (self) -> float:
+		return self.transferred/self.elapsed if self.elapsed else 0
+
+class JobFailed (Exception):
+	'''
+	Raised by a job that ran to the end on ecu, but some of what it did (a read, a flash) didn't succeed
+	'''
+	def __init__ (self, message: str, ecu=None):
+		super().__init__(message)
+		self.ecu = ecu
+
+def parse_fleet (spec: str) -> list[Bench]:
+	'''
+	Comma separated protocol:interface pairs, like kline:/dev/ttyUSB0,kline:/dev/ttyUSB1,canbus:can0
+	'''
+	benches = []
+	for entry in spec.split(','):
+		protocol, _, interface = entry.strip().partition(':')
+		if protocol not in protocols or not interface:
+			raise ValueError('Invalid bench {}, expected protocol:interface with protocol one of {}'.format(entry, ', '.join(protocols)))
+		benches.append(Bench(protocol, interface))
+
+	names = [bench.get_name() for bench in benches]
+	if len(set(names)) != len(names):
+		raise ValueError('Benches have to be on different interfaces')
+	return benches
+
+class ThreadLocalStdout:
+	'''
+	Stands in for sys.stdout and sends every thread's output to the stream
+	it redirected to, or to the original stream if it didn't
+	'''
+	def __init__ (self, stream):
+		self.stream = stream
+		self.local = threading.local()
+
+	def redirect (self, stream) -> None:
+		self.local.stream = stream
+
+	def get_stream (self):
+		return getattr(self.local, 'stream', None) or self.stream
+
+	def write (self, data: str) -> int:
+		return self.get_stream().write(data)
+
+	def flush (self) -> None:
+		self.get_stream().flush()
+
+	def __getattr__ (self, name: str):
+		return getattr(self.stream, name)
+
+class ThreadFilter (logging.Filter):
+	def __init__ (self, thread_id: int):
+		super().__init__()
+		self.thread_id = thread_id
+
+	def filter (self, record: logging.LogRecord) -> bool:
+		return record.thread == self.thread_id
+
+class TrafficMeter:
+	'''
+	Counts the bytes of every request and response executed on the bus
+	'''
+	def __init__ (self, bus: kwp2000.Kwp2000Protocol):
+		self.transferred = 0
+		self.execute = bus.execute
+		bus.execute = self.count
+
+	def count (self, command: kwp2000.Kwp2000Command):
+		response = self.execute(command)
+		self.transferred += 1 + len(command.get_data()) + 1 + len(response.get_data())
+		return response
+
+def run_bench (bench: Bench, result: BenchResult, job: Callable, stop: threading.Event, stdout: ThreadLocalStdout, log_filename: str) -> None:
+	with open(log_filename, 'w') as log:
+		stdout.redirect(log)
+		handler = logging.StreamHandler(log)
+		handler.addFilter(ThreadFilter(threading.get_ident()))
+		handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+		logging.getLogger().addHandler(handler)
+
+		started = time.monotonic()
+		try:
+			ecu = job(bench, result, stop)
+			result.status = 'done' if ecu else 'aborted'
+			result.ecu = ecu.get_name() if ecu else None
+		except JobFailed as e:
+			result.status, result.error = 'failed', str(e)
+			result.ecu = e.ecu.get_name() if e.ecu else None
+		except Exception as e:
+			if stop.is_set():
+				result.status, result.error = 'aborted', 'stopped'
+			else:
+				result.status, result.error = 'failed', '{}: {}'.format(e.__class__.__name__, e)
+			print(traceback.format_exc())
+		finally:
+			result.elapsed = time.monotonic()-started
+			logging.getLogger().removeHandler(handler)
+			stdout.redirect(None)
+
+def run_fleet (benches: list[Bench], job: Callable) -> list[BenchResult]:
+	'''
+	Run job(bench, result, stop) on every bench at once, one thread each. The job returns the ECU
+	it worked on (or None if it gave up), raises JobFailed if it didn't succeed and can fill result.transferred. Everything it prints
+	or logs ends up in fleet_<bench>_<date>.log, the console only gets what the main thread logs.
+	Ctrl+C sets the stop event, the job is expected to give up once it's set. Benches that
+	haven't after stop_timeout seconds are left behind, their threads don't keep the process alive
+	'''
+	results = [BenchResult(bench) for bench in benches]
+	stdout = ThreadLocalStdout(sys.stdout)
+	sys.stdout = stdout
+	stop = threading.Event()
+
+	# bench records go to their own log only, not interleaved on the console
+	console_filter = ThreadFilter(threading.get_ident())
+	console_handlers = list(logging.getLogger().handlers)
+	for handler in console_handlers:
+		handler.addFilter(console_filter)
+
+	threads = []
+	try:
+		for result in results:
+			log_filename = 'fleet_{}_{}.log'.format(result.bench.get_name(), datetime.now().strftime('%Y-%m-%d_%H%M'))
+			print('[*] {}: {} on {}, logging to {}'.format(result.bench.get_name(), result.bench.protocol, result.bench.interface, log_filename))
+			thread = threading.Thread(target=run_bench, args=(result.bench, result, job, stop, stdout, log_filename), name=result.bench.get_name(), daemon=True)
+			thread.start()
+			threads.append(thread)
+
+		try:
+			# joined with a timeout, so Ctrl+C gets through to this thread
+			while any(thread.is_alive() for thread in threads):
+				for thread in threads:
+					thread.join(0.2)
+		except KeyboardInterrupt:
+			print('[!] Stopping the benches..')
+			stop.set()
+			deadline = time.monotonic() + stop_timeout
+			for thread in threads:
+				thread.join(max(0, deadline-time.monotonic()))
+
+			for result in results:
+				if result.status == 'pending':
+					result.status, result.error = 'aborted', 'didn\'t stop in time'
+	finally:
+		for handler in console_handlers:
+			handler.removeFilter(console_filter)
+		sys.stdout = stdout.stream
+
+	return results
+
+def format_summary (results: list[BenchResult]) -> str:
+	rows = [('Bench', 'Interface', 'ECU', 'Status', 'Time', 'Transferred', 'Throughput')]
+	for result in results:
+		rows.append((
+			result.bench.get_name(),
+			result.bench.interface,
+			result.ecu or '-',
+			result.status if not result.error else '{} ({})'.format(result.status, result.error),
+			'{:.0f}s'.format(result.elapsed),
+			'{} B'.format(result.transferred),
+			'{:.0f} B/s'.format(result.throughput()),
+		))
+
+	widths = [max(len(row[column]) for row in rows) for column in range(len(rows[0]))]
+	return '\n'.join('  '.join(value.ljust(width) for value, width in zip(row, widths)).rstrip() for row in rows)
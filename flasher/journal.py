@@ -0,0 +1,59 @@
+import os, re, struct, logging
+
+logger = logging.getLogger(__name__)
+
+record_header = struct.Struct('>LL') # page offset, page length
+
+class PageJournal:
+	'''
+	Sidecar file holding every page fetched so far, so that an interrupted read
+	can be resumed instead of starting from zero. Records are appended as they come:
+	page offset, page length, page data. A record cut short by a crash is ignored
+	'''
+	def __init__ (self, path: str):
+		self.path = path
+		self.pages = {}
+		self.load()
+
+	@staticmethod
+	def filename (ecu_name: str, calibration: str, address_start: int, address_stop: int) -> str:
+		key = '{}_{}_{}_{}'.format(ecu_name, calibration, hex(address_start), hex(address_stop))
+		return '.gkflasher_{}.journal'.format(re.sub(r'[^0-9A-Za-z_]+', '', key))
+
+	def load (self) -> None:
+		try:
+			with open(self.path, 'rb') as file:
+				journal = file.read()
+		except FileNotFoundError:
+			return
+
+		position = 0
+		while position+record_header.size <= len(journal):
+			offset, length = record_header.unpack_from(journal, position)
+			position += record_header.size
+			if position+length > len(journal):
+				logger.warning('Journal %s ends with an incomplete page at %s, discarding it', self.path, hex(offset))
+				break
+			self.pages[offset] = journal[position:position+length]
+			position += length
+
+	def get (self, offset: int) -> bytes:
+		return self.pages.get(offset)
+
+	def append (self, offset: int, page: bytes) -> None:
+		with open(self.path, 'ab') as file:
+			file.write(record_header.pack(offset, len(page)))
+			file.write(page)
+			file.flush()
+			os.fsync(file.fileno())
+		self.pages[offset] = bytes(page)
+
+	def remove (self) -> None:
+		try:
+			os.remove(self.path)
+		except FileNotFoundError:
+			pass
+		self.pages = {}
+
+	def __len__ (self) -> int:
+		return len(self.pages)
@@ -0,0 +1,124 @@
+import time, logging, threading
+from gkbus.protocol import kwp2000
+from gkbus.hardware import TimeoutException
+
+logger = logging.getLogger(__name__)
+
+default_delay = 1.5
+default_poll_interval = 0.1
+# failures in a row after which the ECU is taken to be gone and the loop stops
+default_max_failures = 3
+max_backoff = 8
+
+class KeepalivePolicy:
+	'''
+	Keeps the diagnostic session alive in place of the gkbus keepalive thread. The keepalive
+	command is only sent once the bus has been idle for delay seconds, every time a fixed timer
+	would have fired while real traffic was flowing it counts as skipped. A failed keepalive
+	doubles the wait before the next one (up to max_backoff seconds), after max_failures in a row
+	the loop stops. bus.init() is called without a keepalive command, so gkbus doesn't run its own:
+
+		bus.init(StartCommunication())
+		KeepalivePolicy(bus, TesterPresent(...), delay=1.5).start()
+	'''
+	def __init__ (self, bus: kwp2000.Kwp2000Protocol, command: kwp2000.Kwp2000Command, delay: float = default_delay, poll_interval: float = default_poll_interval, max_failures: int = default_max_failures):
+		self.bus = bus
+		self.command = command
+		self.delay = delay
+		self.poll_interval = poll_interval
+		self.max_failures = max_failures
+		self.sent, self.skipped, self.failed = 0, 0, 0
+
+		self.pending = 0
+		self.last_execution = time.monotonic()
+		self.lock = threading.Lock()
+		self.event = threading.Event()
+		self.thread = None
+
+		# traffic is tracked the same way fleet.TrafficMeter counts it, and the loop
+		# is stopped before the port goes away
+		self.execute, self.close = bus.execute, bus.close
+		bus.execute, bus.close = self.track, self.close_bus
+		bus.keepalive_policy = self
+
+	def track (self, command: kwp2000.Kwp2000Command):
+		with self.lock:
+			self.pending += 1
+		try:
+			return self.execute(command)
+		finally:
+			with self.lock:
+				self.pending -= 1
+				self.last_execution = time.monotonic()
+
+	def close_bus (self) -> None:
+		self.stop()
+		self.close()
+
+	def busy (self) -> bool:
+		with self.lock:
+			return self.pending > 0 or (time.monotonic()-self.last_execution) < self.delay
+
+	def start (self) -> 'KeepalivePolicy':
+		if self.running():
+			return self
+		self.event.clear()
+		self.last_execution = time.monotonic()
+		self.thread = threading.Thread(target=self.run, name='keepalive', daemon=True)
+		self.thread.start()
+		return self
+
+	def stop (self) -> None:
+		self.event.set()
+		if self.thread is not None and self.thread is not threading.current_thread():
+			self.thread.join()
+
+	def running (self) -> bool:
+		return self.thread is not None and self.thread.is_alive()
+
+	def run (self) -> None:
+		due = time.monotonic() + self.delay
+		backoff, failures = self.delay, 0
+
+		while not self.event.wait(self.poll_interval):
+			try:
+				if not self.bus.transport.hardware.is_open():
+					break
+			except AttributeError:
+				# the transport is gone, the bus was closed under us
+				break
+
+			if self.busy():
+				if time.monotonic() >= due:
+					self.skipped += 1
+					due = time.monotonic() + self.delay
+				continue
+
+			if time.monotonic() < due:
+				continue
+
+			try:
+				self.bus.execute(self.command)
+				self.sent += 1
+				backoff, failures = self.delay, 0
+			except (TimeoutException, kwp2000.Kwp2000NegativeResponseException, AttributeError) as e:
+				self.failed += 1
+				failures += 1
+				if failures >= self.max_failures:
+					logger.warning('Keepalive failed %s times in a row, stopping it', failures)
+					break
+				backoff = min(backoff*2, max_backoff)
+				logger.info('Keepalive failed: %s, next try in %.1fs', e.__class__.__name__, backoff)
+				due = time.monotonic() + backoff
+				continue
+			due = time.monotonic() + self.delay
+
+	def get_counters (self) -> dict:
+		return {'sent': self.sent, 'skipped': self.skipped, 'failed': self.failed}
+
+	def reset_counters (self) -> None:
+		self.sent, self.skipped, self.failed = 0, 0, 0
+
+def get_keepalive_counters (bus: kwp2000.Kwp2000Protocol) -> dict:
+	policy = getattr(bus, 'keepalive_policy', None)
+	return policy.get_counters() if policy else {}
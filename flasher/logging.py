@@ -1,11 +1,17 @@
-import csv, time
+import time, struct
 from datetime import datetime
 from gkbus.protocol.kwp2000.commands import *
 from gkbus.protocol.kwp2000.enums import *
+from gkbus.protocol.kwp2000 import Kwp2000NegativeResponseException
+from gkbus.hardware import TimeoutException
 from .ecu import ECU
+from .retry import logger_retry
+from .csvlog import StreamingCsvWriter
+from .rawlog import RawLogWriter, decode_to_csv, source_lid, parameter_layout
 
 # this is not the way to do it, @TODO load data dynamically from GDS definitions
 # definitions below are fine-tuned for ca663056
+# sources are polled as often as possible, unless they set a 'rate' in Hz
 data_sources = [
 	{
 		'payload': ReadDataByLocalIdentifier(0x01),
@@ -295,6 +301,7 @@ data_sources = [
 	},
 #	{
 #		'payload': ReadDataByLocalIdentifier(0x02),
+#		'rate': 1,
 #		'parameters': [
 #			{
 #				'name': 'Cylinder 1 Injection Time',
@@ -341,69 +348,318 @@ def convert (value: bytes, parameter: list):
 		parameter['precision']
 	)
 
+field_formats = {1: 'B', 2: 'H', 4: 'L'}
+# raw values a conversion is checked at before it's folded into scale and offset
+linearity_samples = [0, 1, 2, 3, 10, 100, 255, 256, 1000, 0x1234, 0x7FFF, 0x8000, 0xABCD, 0xFFFF]
+
+def compile_conversion (parameter: dict):
+	'''
+	Function turning the raw field value into the rounded, converted one.
+	Single byte fields get a 256 entry lookup table (which covers the bitfield ones too),
+	linear conversions of wider fields are folded into scale and offset,
+	anything else falls back to calling the conversion
+	'''
+	conversion, precision = parameter['conversion'], parameter['precision']
+
+	if parameter['size'] == 1:
+		return tuple(round(conversion(a), precision) for a in range(256)).__getitem__
+
+	offset = conversion(0)
+	scale = (conversion(0xFFFF)-offset)/0xFFFF
+	if all(round(a*scale+offset, precision) == round(conversion(a), precision) for a in linearity_samples):
+		return lambda a: round(a*scale+offset, precision)
+
+	return lambda a: round(conversion(a), precision)
+
+def field_layout (fields: list[tuple[int, int]]) -> str:
+	'''
+	struct layout unpacking every (position, size) field at once, None if the fields
+	overlap or have a size struct has no format for
+	'''
+	layout, end = '<', 0
+	for position, size in fields:
+		if position < end or size not in field_formats:
+			return None
+		layout += 'x'*(position-end) + field_formats[size]
+		end = position+size
+	return layout
+
+def field_reader (position: int, size: int):
+	if size in field_formats:
+		field = struct.Struct('<' + field_formats[size])
+		return lambda payload: field.unpack_from(payload, position)[0]
+	return lambda payload: int.from_bytes(payload[position:position+size], 'little')
+
+class CompiledSource:
+	'''
+	data_sources entry compiled for decoding: one struct unpacks every field of a frame
+	at once, every parameter then only takes its field through a precomputed conversion.
+	Parameters reading the same field (like bitfields) share it. Sources with overlapping
+	or odd-sized fields fall back to unpacking every field on its own
+	'''
+	def __init__ (self, source: dict):
+		self.source = source
+		self.parameters = source['parameters']
+
+		fields = sorted({(parameter['position'], parameter['size']) for parameter in self.parameters})
+		self.size = max((position+size for position, size in fields), default=0)
+
+		layout = field_layout(fields)
+		if layout is not None:
+			self.struct = struct.Struct(layout)
+			self.readers = None
+		else:
+			self.struct = None
+			self.readers = [field_reader(position, size) for position, size in fields]
+
+		self.fields = [fields.index((parameter['position'], parameter['size'])) for parameter in self.parameters]
+		self.conversions = [compile_conversion(parameter) for parameter in self.parameters]
+
+	def unpack_fields (self, payload: bytes) -> tuple:
+		if len(payload) < self.size:
+			# a short frame reads as zeros past its end, like slicing it did
+			payload = bytes(payload).ljust(self.size, b'\x00')
+		if self.struct is not None:
+			return self.struct.unpack_from(payload)
+		return tuple(reader(payload) for reader in self.readers)
+
+	def unpack (self, payload: bytes) -> list[int]:
+		'''
+		Raw value of every parameter
+		'''
+		values = self.unpack_fields(payload)
+		return [values[field] for field in self.fields]
+
+	def decode (self, payload: bytes) -> list:
+		values = self.unpack_fields(payload)
+		return [conversion(values[field]) for field, conversion in zip(self.fields, self.conversions)]
+
+	def decode_many (self, frames: bytes, length: int) -> list[list]:
+		'''
+		Decode back to back frames of length (> 0) bytes each, with a single iter_unpack
+		when the fields fit one struct and the frames are long enough for it
+		'''
+		if self.struct is None or length < self.struct.size:
+			return [self.decode(frames[position:position+length]) for position in range(0, len(frames), length)]
+
+		frame = struct.Struct(self.struct.format + 'x'*(length-self.struct.size))
+		return [[conversion(values[field]) for field, conversion in zip(self.fields, self.conversions)] for values in frame.iter_unpack(frames)]
+
+def compile_data_sources (sources: list[dict]) -> list[CompiledSource]:
+	return [CompiledSource(source) for source in sources]
+
+decoders = compile_data_sources(data_sources)
+
+# dynamically defined local identifiers are numbered from here on
+dynamic_local_identifier = 0xF0
+
+def select_channels (sources: list[dict], channels: list[str]) -> list[dict]:
+	'''
+	Copies of the sources holding only the named parameters, sources left empty are dropped
+	'''
+	wanted = {channel.strip().lower() for channel in channels}
+	known = {parameter['name'].lower() for source in sources for parameter in source['parameters']}
+	if wanted - known:
+		raise ValueError('Unknown channel(s): {}'.format(', '.join(sorted(wanted - known))))
+
+	selected = []
+	for source in sources:
+		parameters = [parameter for parameter in source['parameters'] if parameter['name'].lower() in wanted]
+		if parameters:
+			selected.append(dict(source, parameters=parameters))
+	return selected
+
+def pack_source (source: dict, local_identifier: int) -> tuple[list[DynamicallyDefineLocalIdentifier], dict]:
+	'''
+	DynamicallyDefineLocalIdentifier requests (defineByLocalIdentifier) copying only the bytes
+	the source's parameters read into local_identifier, and the source reading them from there.
+	Positions in the record are 1-based, which is exactly our positions since byte 0 of the response is the echo
+	'''
+	record_local_identifier = source['payload'].get_data()[0]
+
+	ranges = []
+	for position, size in sorted({(parameter['position'], parameter['size']) for parameter in source['parameters']}):
+		if ranges and position <= ranges[-1][1]:
+			ranges[-1] = (ranges[-1][0], max(ranges[-1][1], position+size))
+		else:
+			ranges.append((position, position+size))
+
+	definitions = [DynamicallyDefineLocalIdentifier(bytes([local_identifier, 0x04]))] # clear whatever was defined before
+	packed_positions, packed_position = {}, 1
+	for start, stop in ranges:
+		definitions.append(DynamicallyDefineLocalIdentifier(bytes([local_identifier, 0x01, packed_position, stop-start, record_local_identifier, start])))
+		packed_positions[start] = packed_position
+		packed_position += stop-start
+
+	def repack (parameter: dict) -> dict:
+		start = max(start for start, stop in ranges if start <= parameter['position'])
+		return dict(parameter, position=packed_positions[start]+parameter['position']-start, origin=(record_local_identifier, parameter['position']))
+
+	return definitions, dict(source, payload=ReadDataByLocalIdentifier(local_identifier), parameters=[repack(parameter) for parameter in source['parameters']])
+
+def define_packed_sources (ecu: ECU, sources: list[dict]) -> list[dict]:
+	'''
+	Define a local identifier holding just the needed bytes for every source and return
+	the sources reading from them. A source the ECU won't pack is read from its full local identifier
+	'''
+	packed = []
+	for index, source in enumerate(sources):
+		definitions, packed_source = pack_source(source, dynamic_local_identifier+index)
+		try:
+			for definition in definitions:
+				ecu.bus.execute(definition)
+			ecu.bus.execute(packed_source['payload'])
+		except (Kwp2000NegativeResponseException, TimeoutException) as e:
+			print('[!] Couldn\'t pack local identifier {} ({}), reading all of it'.format(hex(source['payload'].get_data()[0]), e))
+			packed.append(source)
+			continue
+
+		print('[*] Local identifier {} packed into {}'.format(hex(source['payload'].get_data()[0]), hex(dynamic_local_identifier+index)))
+		packed.append(packed_source)
+	return packed
+
+def prepare_sources (ecu: ECU, channels: list[str] = None) -> list[dict]:
+	'''
+	All data sources, or only the selected channels packed into dynamically defined local identifiers
+	'''
+	if not channels:
+		return data_sources
+	return define_packed_sources(ecu, select_channels(data_sources, channels))
+
+def poll_source (ecu: ECU, decoder: CompiledSource) -> list:
+	return decoder.decode(logger_retry.call(ecu.bus.execute, decoder.source['payload']).get_data())
+
 def poll (ecu: ECU) -> list[int]:
 	data = []
-	for source in data_sources:
-		raw_data = ecu.bus.execute(source['payload']).get_data()
-		for parameter in source['parameters']:
-			value = grab(raw_data, parameter)
-			value_converted = convert(value, parameter)
-			data.append(value_converted)
-			print('{}: {}{} ({})'.format(parameter['name'], value_converted, parameter['unit'], hex(int.from_bytes(value, 'little'))))
+	for decoder in decoders:
+		data += poll_source(ecu, decoder)
 	return data
 
-def logger(ecu: ECU) -> None:
-	ecu.bus.execute(StartDiagnosticSession(DiagnosticSession.DEFAULT, ecu.get_desired_baudrate().index))
+class PollScheduler:
+	'''
+	Picks the data source to request next. Sources with a 'rate' (in Hz) are requested
+	whenever they're due, most overdue first. Sources without one take turns in all the time
+	that's left, so slow sources cost the fast ones only the requests they actually need.
+	A source that fell behind is requested once, not once for every slot it missed
+	'''
+	def __init__ (self, decoders: list[CompiledSource]):
+		self.fast = [decoder for decoder in decoders if not decoder.source.get('rate')]
+		self.timed = [decoder for decoder in decoders if decoder.source.get('rate')]
+		self.due = [time.monotonic()]*len(self.timed)
+		self.turn = 0
+
+	def next (self) -> CompiledSource:
+		while True:
+			now = time.monotonic()
+			if self.timed:
+				due, index = min((due, index) for index, due in enumerate(self.due))
+				if due <= now:
+					period = 1/self.timed[index].source['rate']
+					self.due[index] = due+period if due+period > now else now+period
+					return self.timed[index]
+
+			if self.fast:
+				self.turn += 1
+				return self.fast[(self.turn-1) % len(self.fast)]
+
+			time.sleep(due-now)
+
+def logger(ecu: ECU, channels: list[str] = None) -> None:
+	ecu.session.require(DiagnosticSession.DEFAULT)
+	sources = prepare_sources(ecu, channels)
+	source_decoders = compile_data_sources(sources)
 
 	print('[*] Building parameter header')
-	data = [['Unix timestamp']]
-	for source in data_sources:
+	header = ['Unix timestamp']
+	for source in sources:
 		for parameter in source['parameters']:
-			data[0].append('{} ({})'.format(parameter['name'], parameter['unit']))
+			header.append('{} ({})'.format(parameter['name'], parameter['unit']))
 
-	print('[*] Logging..')
+	print('[*] Logging to log.csv..\n')
 	
-	try:
-		while True:
-			data.append([int(time.time()*1000)] + poll(ecu))
-	except (KeyboardInterrupt, AttributeError):
-		with open('log.csv', 'w') as csvfile:
-			logwriter = csv.writer(csvfile)
-			for entry in data:
-				logwriter.writerow(entry)
+	with StreamingCsvWriter('log.csv') as logwriter:
+		logwriter.writerow(header)
+		try:
+			# every row holds the latest values of every source, slow ones are repeated until they're polled again
+			latest = {decoder: poll_source(ecu, decoder) for decoder in source_decoders}
+			logwriter.writerow([int(time.time()*1000)] + [value for decoder in source_decoders for value in latest[decoder]])
+
+			scheduler = PollScheduler(source_decoders)
+			rows = 1
+			while True:
+				decoder = scheduler.next()
+				latest[decoder] = poll_source(ecu, decoder)
+				logwriter.writerow([int(time.time()*1000)] + [value for decoder in source_decoders for value in latest[decoder]])
+				rows += 1
 
-# log only raw bytes for XDL conversion
-# inefficient, ugly and the file format makes no sense
-# for development purposes only
+				# printing every value would cost more than polling it
+				if rows % 10 == 0:
+					print('\033[Frows: {}'.format(rows))
+		except (KeyboardInterrupt, AttributeError):
+			pass
+
+# log only raw frames, decoding happens later with --decode-log
+# so polling isn't slowed down by anything
 
 def poll_raw (ecu: ECU) -> bytes:
 	data = []
 	for source in data_sources:
-		raw_data = ecu.bus.execute(source['payload']).get_data()
+		raw_data = logger_retry.call(ecu.bus.execute, source['payload']).get_data()
 		data.append(raw_data)
 	return data
 
-def logger_raw (ecu: ECU) -> None:
-	ecu.bus.execute(StartDiagnosticSession(DiagnosticSession.DEFAULT, ecu.get_desired_baudrate().index))
+def logger_raw (ecu: ECU, channels: list[str] = None) -> None:
+	ecu.session.require(DiagnosticSession.DEFAULT)
+	sources = prepare_sources(ecu, channels)
 
-	output_filename = 'log_raw_{}.csv'.format(datetime.now().strftime('%Y-%m-%d_%H%M'))
+	output_filename = 'log_raw_{}.gklog'.format(datetime.now().strftime('%Y-%m-%d_%H%M'))
 
 	print('[*] Logging to {}..\n'.format(output_filename))
 
-	with open(output_filename, 'w') as csvfile:
-		logwriter = csv.writer(csvfile)
+	with RawLogWriter(output_filename, sources) as logwriter:
 		try:
-			i = 0
-			frames = []
+			scheduler = PollScheduler(compile_data_sources(sources))
 			while True:
-				data = poll_raw(ecu)[0]
-				data_hex = ' '.join([hex(x) for x in list(data)])
-				frames.append([int(time.time()*1000), data_hex])
-				i += 1
-
-				if i % 10 == 0:
-					logwriter.writerows(frames)
-					frames = []
-					print('\033[Fframes: {}'.format(i))
-		except KeyboardInterrupt: # up to 10 last frames might be lost here
-			pass
\ No newline at end of file
+				source = scheduler.next().source
+				logwriter.write(source_lid(source), logger_retry.call(ecu.bus.execute, source['payload']).get_data())
+
+				if logwriter.frames % 10 == 0:
+					print('\033[Fframes: {}'.format(logwriter.frames))
+		except KeyboardInterrupt:
+			pass
+
+def header_decoders (header: dict) -> list[CompiledSource]:
+	'''
+	Decoders for the sources a raw log was taken with. Positions come from the header,
+	since the log may have been taken from packed local identifiers, conversions
+	are looked up by parameter name in data_sources. A parameter whose layout in data_sources
+	changed since the log was taken is warned about, if its size changed the conversion
+	can't be trusted on the logged bytes and it's skipped
+	'''
+	definitions = {parameter['name']: (source, parameter) for source in data_sources for parameter in source['parameters']}
+	if any('layout' not in parameter for source in header['sources'] for parameter in source['parameters']):
+		print('[!] Log was taken without its layout, can\'t tell if the definitions changed since')
+
+	header_sources = []
+	for source in header['sources']:
+		parameters = []
+		for parameter in source['parameters']:
+			if parameter['name'] not in definitions:
+				print('[!] No definition for {} anymore, skipping it'.format(parameter['name']))
+				continue
+			definition_source, definition = definitions[parameter['name']]
+			layout = parameter_layout(definition_source, definition)
+			if parameter.get('layout', layout) != layout:
+				if parameter['layout'][2] != layout[2]:
+					print('[!] Size of {} changed since the log was taken, skipping it'.format(parameter['name']))
+					continue
+				print('[!] Layout of {} changed since the log was taken (local identifier {} position {}, now {} position {})'.format(parameter['name'], hex(parameter['layout'][0]), parameter['layout'][1], hex(layout[0]), layout[1]))
+			parameters.append(dict(parameter, conversion=definition['conversion']))
+		header_sources.append({'payload': ReadDataByLocalIdentifier(source['lid']), 'parameters': parameters})
+	return compile_data_sources(header_sources)
+
+def decode_raw_log (filename: str, output_filename: str = None) -> str:
+	'''
+	Turn a logger_raw file into the same CSV logger writes
+	'''
+	return decode_to_csv(filename, header_decoders, output_filename=output_filename)
@@ -1,131 +1,605 @@
-import logging
+import os, time, logging, re, hashlib, mmap
 from math import ceil
+from dataclasses import dataclass, field
 from gkbus.protocol import kwp2000
 from gkbus.protocol.kwp2000.commands import ReadMemoryByAddress, WriteMemoryByAddress, RequestDownload, TransferData, RequestTransferExit
 from gkbus.protocol.kwp2000.enums import CompressionType, EncryptionType
 from gkbus.hardware import TimeoutException
+from ecu_definitions import AccessLevel
 from .ecu import ECU
+from .profile import profiles, ecu_profile_key
+from .journal import PageJournal
+from .retry import RetryPolicy, memory_retry
 logger = logging.getLogger(__name__)
 
 page_size_b = 16384
 
+# a K-Line frame can't carry more than 254 bytes of data after the response service identifier.
+# CAN could take 255, but a 16 KiB page takes 65 requests either way
+default_transfer_size = 254
+
+# every segment costs a RequestDownload and RequestTransferExit round trip,
+# blank runs shorter than this are cheaper to just write
+default_min_blank_gap = 1024
+segment_alignment = 16
+
+# this many requests in a row running out of retries means the link is dead, not flaky
+max_consecutive_timeouts = 2
+
+repair_chunk_size = 16
+# the repair pass leaves whatever is still missing once it re-read this many bytes or ran this long
+repair_max_bytes = 0x4000
+repair_max_time = 60
+
+# the ECU won't ever upload from these addresses, they're gaps in the map rather than read errors
+restricted_statuses = (
+	kwp2000.Kwp2000NegativeStatusIdentifierEnum.REQUEST_OUT_OF_RANGE.value,
+	kwp2000.Kwp2000NegativeStatusIdentifierEnum.CANT_UPLOAD_FROM_SPECIFIED_ADDRESS.value,
+)
+
+# pages compared by zone_matches, spread evenly over the zone. Sampling can miss a small
+# patch, it's only done once the identification the ECU reports was found in the image
+default_sample_pages = 4
+repair_retry = RetryPolicy('repair', max_attempts=3, backoff=0.5, budget=10, exceptions=(kwp2000.Kwp2000NegativeResponseException, TimeoutException))
+
+@dataclass
+class ReadResult:
+	'''
+	Outcome of read_memory. failed_ranges are (start, stop) addresses that couldn't
+	be read even after the repair pass, they're filled with 0xFF in the buffer.
+	restricted_ranges are (start, stop) addresses the ECU refuses to upload from, they're
+	filled with 0xFF too but aren't retried and don't count as a failure.
+	interrupted is set when the read was cut short, the repair pass is skipped then
+	'''
+	buffer: bytearray
+	failed_ranges: list[tuple[int, int]] = field(default_factory=list)
+	restricted_ranges: list[tuple[int, int]] = field(default_factory=list)
+	interrupted: bool = False
+
+	def success (self) -> bool:
+		return not self.failed_ranges and not self.interrupted
+
+@dataclass
+class VerifyResult:
+	'''
+	Outcome of verify_written_pages. Ranges are (start, stop) relative to the payload.
+	rewritten_ranges were written again and read back fine, mismatched_ranges still
+	differ (or couldn't be read back) and need the whole zone flashed again
+	'''
+	mismatched_ranges: list[tuple[int, int]] = field(default_factory=list)
+	rewritten_ranges: list[tuple[int, int]] = field(default_factory=list)
+
+	def success (self) -> bool:
+		return not self.mismatched_ranges
+
 # This function rounds upto the nearest multiple. 
 # KWP frames are 256 bytes and the FTDI buffer 512 bytes.
 # This prevents an overflow situation when writing different sized binaries.
 def round_to_multiple(number: int, multiple: int) -> int:  
         return multiple * ceil(number / multiple)
 
-def dynamic_find_end (payload):
-	end_offset = len(payload)-1
+blank_block = b'\xFF'*4096
 
-	try:
-		while payload[end_offset] == 0xFF:
-			end_offset -= 1
-	except IndexError:
-		pass
+def dynamic_find_end (payload) -> int:
+	'''
+	Length of the payload without trailing 0xFFs, rounded up to a multiple of 254.
+	Compares whole blocks from the end instead of walking byte by byte
+	'''
+	payload = memoryview(payload)
+	end_offset = len(payload)
+
+	while end_offset >= len(blank_block) and payload[end_offset-len(blank_block):end_offset] == blank_block:
+		end_offset -= len(blank_block)
+
+	tail_start = max(0, end_offset-len(blank_block))
+	end_offset = tail_start + len(bytes(payload[tail_start:end_offset]).rstrip(b'\xFF'))
 
 	return round_to_multiple(end_offset, 254)
 
-def read_page_16kib(ecu: ECU, offset: int, at_a_time: int = 254, progress_callback=False) -> bytearray:
+def plan_segments (payload: bytes, min_gap: int = default_min_blank_gap) -> list[tuple[int, int]]:
+	'''
+	Split the payload into (start, stop) ranges that actually have to be written.
+	Runs of 0xFF at least min_gap bytes long are skipped, they're already 0xFF after
+	the zone is erased. Gaps are shrunk to segment_alignment. min_gap=0 disables skipping
+	'''
+	if len(payload) == 0:
+		return []
+	if min_gap <= 0:
+		return [(0, len(payload))]
+
+	segments = []
+	segment_start = 0
+	for blank in re.finditer(rb'\xff{%d,}' % min_gap, payload):
+		gap_start = round_to_multiple(blank.start(), segment_alignment)
+		gap_stop = blank.end() - blank.end() % segment_alignment
+		if blank.end() == len(payload):
+			gap_stop = len(payload)
+
+		if (gap_stop-gap_start) < min_gap:
+			continue
+
+		if gap_start > segment_start:
+			segments.append((segment_start, gap_start))
+		segment_start = gap_stop
+
+	if segment_start < len(payload):
+		segments.append((segment_start, len(payload)))
+
+	return segments
+
+class MappedDump:
+	'''
+	Memory-mapped dump pre-sized to size bytes of 0xFF. Entering yields a writable memoryview,
+	so reads land straight in their final place and whatever was read is already on disk if we die halfway.
+	It's built in filename.part, which only replaces filename when the with block ends without
+	an exception and without discard() being called, an existing file is never left half written.
+	Views sliced from it have to be released before exiting
+	'''
+	def __init__ (self, filename: str, size: int):
+		self.filename = filename
+		self.size = size
+		self.part_filename = filename + '.part'
+		self.discarded = False
+
+	def __enter__ (self) -> memoryview:
+		with open(self.part_filename, 'w+b') as file:
+			for position in range(0, self.size, len(blank_block)):
+				file.write(blank_block[:self.size-position])
+			file.flush()
+			self.mapping = mmap.mmap(file.fileno(), self.size)
+
+		self.view = memoryview(self.mapping)
+		return self.view
+
+	def discard (self) -> None:
+		'''
+		Keep filename as it is, what was read stays in filename.part
+		'''
+		self.discarded = True
+
+	def __exit__ (self, exc_type, *args) -> None:
+		self.view.release()
+		self.mapping.flush()
+		try:
+			self.mapping.close()
+		except BufferError:
+			# a view is still held by a traceback, the mapping goes away with it
+			logger.debug('Dump %s is still referenced, leaving it mapped', self.part_filename)
+
+		if exc_type is None and not self.discarded:
+			os.replace(self.part_filename, self.filename)
+
+def read_range (ecu: ECU, offset: int, size: int, at_a_time: int = default_transfer_size, progress_callback=False, failed_ranges: list = None, retry_policy: RetryPolicy = memory_retry, buffer=None, restricted_ranges: list = None, retry_ranges: list = None) -> bytearray:
+	'''
+	Read size bytes from offset. Sections that fail are left as 0xFF and added to failed_ranges,
+	or to restricted_ranges (if passed) when the ECU refused them with one of restricted_statuses,
+	or to retry_ranges (if passed) when they timed out or got a "not now" answer retry_policy gave up on.
+	If buffer is passed (size bytes, already filled with 0xFF), data is read straight into it
+	'''
+	# a session started since (an --id switches to DEFAULT) dropped the access level reads need
+	ecu.session.require(ecu.get_diagnostic_session_type(), access_level=AccessLevel.HYUNDAI_0x1)
+
 	address_start = offset
-	address_stop = offset+page_size_b
+	address_stop = offset+size
 	address = address_start
 
-	payload = bytearray([0xFF]*(address_stop-address_start))
+	payload = buffer if buffer is not None else bytearray(b'\xFF')*size
+	consecutive_timeouts = 0
 
 	while True:
 		if ( (address_stop-address) < at_a_time ):
 			at_a_time = (address_stop-address)
 
+		request_size = at_a_time
+		# split the request exactly where the ECU won't let us read across
+		boundary = min((x for x in ecu.get_read_boundaries() if address < x < address+request_size), default=None)
+		if boundary:
+			request_size = boundary-address
+
 		try:
-			fetched = ecu.read_memory_by_address(offset=address, size=at_a_time)
+			fetched = retry_policy.call(ecu.read_memory_by_address, offset=address, size=request_size)
 		except kwp2000.Kwp2000NegativeResponseException as e:
-			logger.warning('Negative KWP response at offset %s! Filling requested section with 0xF. %s', hex(address), e)
+			if e.status.identifier in (
+					kwp2000.Kwp2000NegativeStatusIdentifierEnum.CANT_UPLOAD_REQUESTED_NUMBER_OF_BYTES.value,
+					kwp2000.Kwp2000NegativeStatusIdentifierEnum.RESPONSE_TOO_LONG.value
+				) and at_a_time > 1:
+				at_a_time = default_transfer_size if at_a_time > default_transfer_size else at_a_time//2
+				logger.warning('Transfer size rejected at offset %s, retrying with %s bytes. %s', hex(address), at_a_time, e)
+				continue
 			fetched = bytes()
+			if restricted_ranges is not None and e.status.identifier in restricted_statuses:
+				logger.info('Offset %s is restricted, filling requested section with 0xFF. %s', hex(address), e)
+				restricted_ranges.append((address, address+request_size))
+			elif retry_ranges is not None and retry_policy.retryable(e):
+				logger.warning('Negative KWP response at offset %s, out of retries! Filling requested section with 0xFF. %s', hex(address), e)
+				retry_ranges.append((address, address+request_size))
+			else:
+				logger.warning('Negative KWP response at offset %s! Filling requested section with 0xF. %s', hex(address), e)
+				if failed_ranges is not None:
+					failed_ranges.append((address, address+request_size))
 		except TimeoutException:
-			logger.warning('Timeout at Offset %s! Trying again...', hex(address))
-			continue
+			consecutive_timeouts += 1
+			if consecutive_timeouts >= max_consecutive_timeouts:
+				logger.error('Timeout at offset %s, out of retries again! Giving up', hex(address))
+				raise
+			logger.warning('Timeout at offset %s, out of retries! Filling requested section with 0xFF', hex(address))
+			fetched = bytes()
+			if retry_ranges is not None:
+				retry_ranges.append((address, address+request_size))
+			elif failed_ranges is not None:
+				failed_ranges.append((address, address+request_size))
+		else:
+			consecutive_timeouts = 0
 
 		payload_start = address-address_start
 		payload_stop = payload_start+len(fetched)
 		payload[payload_start:payload_stop] = fetched
 
-		address += at_a_time
+		address += request_size
 
 		if (progress_callback):
-			progress_callback(at_a_time)
+			progress_callback(request_size)
 
 		if (address >= address_stop):
 			break
 	return payload
 
+def read_page_16kib(ecu: ECU, offset: int, at_a_time: int = default_transfer_size, progress_callback=False, failed_ranges: list = None, retry_policy: RetryPolicy = memory_retry, buffer=None, restricted_ranges: list = None, retry_ranges: list = None) -> bytearray:
+	return read_range(ecu, offset, page_size_b, at_a_time=at_a_time, progress_callback=progress_callback, failed_ranges=failed_ranges, retry_policy=retry_policy, buffer=buffer, restricted_ranges=restricted_ranges, retry_ranges=retry_ranges)
+
+
+def load_read_boundaries (ecu: ECU) -> None:
+	for boundary in profiles.get(ecu_profile_key(ecu, 'read_boundaries'), []):
+		ecu.add_read_boundary(boundary)
+
+def save_read_boundaries (ecu: ECU) -> None:
+	profiles.set(ecu_profile_key(ecu, 'read_boundaries'), sorted(ecu.get_read_boundaries()))
+
+def page_offsets (address_start: int, address_stop: int) -> list[int]:
+	return list(range(address_start, address_stop, page_size_b))
+
+def merge_ranges (ranges: list[tuple[int, int]]) -> list[tuple[int, int]]:
+	merged = []
+	for start, stop in sorted(ranges):
+		if merged and start <= merged[-1][1]:
+			merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+		else:
+			merged.append((start, stop))
+	return merged
+
+def repair_ranges (ecu: ECU, buffer: bytearray, buffer_address: int, failed_ranges: list[tuple[int, int]], chunk_size: int = repair_chunk_size, retry_policy: RetryPolicy = repair_retry, restricted_ranges: list = None, max_bytes: int = repair_max_bytes, max_time: float = repair_max_time) -> list[tuple[int, int]]:
+	'''
+	Read the failed ranges again in small chunks, retrying with backoff.
+	Recovered data is put straight into the buffer. Chunks refused with one of restricted_statuses
+	are added to restricted_ranges (if passed). Stops after max_bytes or max_time seconds,
+	returns ranges that are still unreadable including the ones it didn't get to
+	'''
+	unrecovered = []
+	started = time.monotonic()
+	repaired = 0
+	stopped = False
+
+	for range_start, range_stop in failed_ranges:
+		for chunk_start in range(range_start, range_stop, chunk_size):
+			chunk_stop = min(chunk_start+chunk_size, range_stop)
+
+			if not stopped and (repaired >= max_bytes or time.monotonic()-started >= max_time):
+				logger.warning('Repair pass stopped at %s after %s bytes and %.0fs', hex(chunk_start), repaired, time.monotonic()-started)
+				stopped = True
+			if stopped:
+				unrecovered.append((chunk_start, range_stop))
+				break
+			repaired += chunk_stop-chunk_start
+
+			try:
+				fetched = retry_policy.call(ecu.read_memory_by_address, offset=chunk_start, size=chunk_stop-chunk_start)
+			except kwp2000.Kwp2000NegativeResponseException as e:
+				if restricted_ranges is not None and e.status.identifier in restricted_statuses:
+					restricted_ranges.append((chunk_start, chunk_stop))
+				else:
+					unrecovered.append((chunk_start, chunk_stop))
+				continue
+			except TimeoutException:
+				unrecovered.append((chunk_start, chunk_stop))
+				continue
+
+			buffer_start = chunk_start-buffer_address
+			buffer[buffer_start:buffer_start+len(fetched)] = fetched
+
+	return merge_ranges(unrecovered)
 
 # read memory into a buffer
 # this function only cares about reading from address_start to address_stop. 
 # it doesn't pad the read with 0xFFs or anything. If you request to read, for example,
 # the calibration zone, from 0x090000 to 0x094000 (16364 bytes) - then you'll only
 # get 16364 bytes back. 
-def read_memory(ecu: ECU, address_start: int, address_stop: int, progress_callback=False) -> bytearray:#, progress_callback):
+# pass a buffer (for example a slice of a MappedDump) to have the data read straight into it,
+# it has to be requested_size bytes long and filled with 0xFF.
+# sections that time out (or stay busy) are remembered and re-read in a repair pass at the end, 
+# whatever is still missing after that ends up in ReadResult.failed_ranges, next to sections
+# the ECU gave any other negative response for, those would fail the same way again.
+# addresses the ECU refuses to upload from go to ReadResult.restricted_ranges instead,
+# they're neither repaired nor a failure.
+# if a journal is passed, pages already present in it are not fetched again 
+# and every page fetched without failures or restricted ranges is appended to it
+def read_memory(ecu: ECU, address_start: int, address_stop: int, progress_callback=False, at_a_time: int = default_transfer_size, journal: PageJournal = None, retry_policy: RetryPolicy = memory_retry, buffer=None) -> ReadResult:
 	requested_size = address_stop-address_start
-	pages = int(requested_size/page_size_b) # 16kib per page 
-	buffer = bytearray([0xFF]*requested_size)
+	pages = ceil(requested_size/page_size_b) # 16kib per page 
+	result = ReadResult(buffer=buffer if buffer is not None else bytearray(b'\xFF')*requested_size)
 	address = address_start
 
+	load_read_boundaries(ecu)
+	known_boundaries = set(ecu.get_read_boundaries())
+	retry_ranges = []
+
 	try:
-		page = 0
-		while True:
-			if (progress_callback):
-				progress_callback.title('Page {}/{}, offset {}'.format(page+1, pages, hex(address)))
-
-			fetched = read_page_16kib(ecu, offset=address, progress_callback=progress_callback)
-			
-			buffer_start = (address-address_start)
-			buffer_end = buffer_start + len(fetched)
-			buffer[buffer_start:buffer_end] = fetched
-			
-			address += page_size_b # 16kib per page 
-			
-			if (address >= address_stop):
-				break
+		with memoryview(result.buffer) as view:
+			page = 0
+			while True:
+				if (progress_callback):
+					progress_callback.title('Page {}/{}, offset {}'.format(page+1, pages, hex(address)))
+
+				# the last page is cut short if address_stop isn't page aligned
+				buffer_start = (address-address_start)
+				buffer_end = buffer_start + min(page_size_b, address_stop-address)
+
+				fetched = journal.get(address) if journal is not None else None
+				if fetched is None:
+					page_failed_ranges, page_restricted_ranges, page_retry_ranges = [], [], []
+					fetched = read_range(ecu, address, buffer_end-buffer_start, at_a_time=at_a_time, progress_callback=progress_callback, failed_ranges=page_failed_ranges, retry_policy=retry_policy, buffer=view[buffer_start:buffer_end], restricted_ranges=page_restricted_ranges, retry_ranges=page_retry_ranges)
+					if journal is not None and not page_failed_ranges and not page_restricted_ranges and not page_retry_ranges:
+						journal.append(address, fetched)
+					result.failed_ranges += page_failed_ranges
+					result.restricted_ranges += page_restricted_ranges
+					retry_ranges += page_retry_ranges
+				else:
+					view[buffer_start:buffer_end] = fetched[:buffer_end-buffer_start]
+					if (progress_callback):
+						progress_callback(buffer_end-buffer_start)
+				
+				address += page_size_b # 16kib per page 
+				
+				if (address >= address_stop):
+					break
 
-			page +=1
+				page +=1
+
+			if retry_ranges:
+				repair = merge_ranges(retry_ranges)
+				if (progress_callback):
+					progress_callback.title('Repairing {} range(s)'.format(len(repair)))
+				logger.info('Repairing %s range(s)', len(repair))
+				result.failed_ranges += repair_ranges(ecu, view, address_start, repair, restricted_ranges=result.restricted_ranges)
+				retry_ranges = []
+
+				if journal is not None:
+					for offset in page_offsets(address_start, address_stop):
+						if journal.get(offset) is None and not any(start < offset+page_size_b and stop > offset for start, stop in result.failed_ranges + result.restricted_ranges):
+							journal.append(offset, view[offset-address_start:offset-address_start+page_size_b])
 
 	except KeyboardInterrupt:
-		pass
-
-	return buffer
-
-def write_memory(ecu: ECU, payload: bytes, flash_start: int, flash_size: int, progress_callback=False) -> None:
-	ecu.bus.execute(
-		RequestDownload(
-			offset=flash_start, 
-			size=flash_size, 
-			compression_type=CompressionType.UNCOMPRESSED, 
-			encryption_type=EncryptionType.UNENCRYPTED
-		)
+		result.interrupted = True
+	finally:
+		# whatever the repair pass didn't get to is still missing
+		result.failed_ranges = merge_ranges(result.failed_ranges + retry_ranges)
+		result.restricted_ranges = merge_ranges(result.restricted_ranges)
+		if ecu.get_read_boundaries() != known_boundaries:
+			save_read_boundaries(ecu)
+
+	return result
+
+@dataclass
+class Download:
+	'''
+	One RequestDownload/TransferData/RequestTransferExit sequence, built ahead of time.
+	packets are (progress title, TransferData command, payload length) tuples
+	'''
+	request: RequestDownload
+	packets: list[tuple[str, TransferData, int]]
+
+@dataclass
+class FlashPlan:
+	'''
+	Everything needed to write a zone, prepared by prepare_flash_plan while the ECU is still erasing.
+	payload is trimmed with dynamic_find_end, segments are relative to it and page_hashes
+	is None unless verification was asked for
+	'''
+	payload: memoryview
+	flash_start: int
+	segments: list[tuple[int, int]]
+	downloads: list[Download]
+	page_hashes: dict = None
+
+	def flash_size (self) -> int:
+		return sum(segment_stop-segment_start for segment_start, segment_stop in self.segments)
+
+def build_download (payload: bytes, flash_start: int, flash_size: int) -> Download:
+	payload = memoryview(payload)
+	request = RequestDownload(
+		offset=flash_start, 
+		size=flash_size, 
+		compression_type=CompressionType.UNCOMPRESSED, 
+		encryption_type=EncryptionType.UNENCRYPTED
 	)
 
 	packets_to_write = int(flash_size/254)
 	if (flash_size % 254 != 0):
 		packets_to_write += 1
 
+	packets = []
 	for packets_written in range(packets_to_write):
-		if (progress_callback):
-			progress_callback.title('Packet {}/{}'.format(packets_written, packets_to_write))
+		payload_packet = bytes(payload[packets_written*254:(packets_written+1)*254])
+		packets.append(('Packet {}/{}'.format(packets_written, packets_to_write), TransferData(payload_packet), len(payload_packet)))
 
-		payload_packet_start = packets_written*254
-		payload_packet_end = payload_packet_start+254
-		payload_packet = payload[payload_packet_start:payload_packet_end]
+	return Download(request, packets)
 
-		while True:
-			try:
-				ecu.bus.execute(TransferData(payload_packet))
-				break
-			except TimeoutException:
-				logger.warning('Timeout at Block %s! Trying again...', packets_written)
-				continue
+def send_download (ecu: ECU, download: Download, progress_callback=False, retry_policy: RetryPolicy = memory_retry) -> None:
+	ecu.bus.execute(download.request)
+
+	for packets_written, (title, packet, size) in enumerate(download.packets):
+		if (progress_callback):
+			progress_callback.title(title)
+
+		try:
+			retry_policy.call(ecu.bus.execute, packet)
+		except TimeoutException:
+			logger.error('Timeout at block %s, out of retries!', packets_written)
+			raise
 		
 		if (progress_callback):
-			progress_callback(len(payload_packet))
+			progress_callback(size)
+
+	ecu.bus.execute(RequestTransferExit())
+
+def write_memory(ecu: ECU, payload: bytes, flash_start: int, flash_size: int, progress_callback=False, retry_policy: RetryPolicy = memory_retry) -> None:
+	ecu.session.require(ecu.get_diagnostic_session_type(), access_level=AccessLevel.HYUNDAI_0x1)
+	send_download(ecu, build_download(payload, flash_start, flash_size), progress_callback=progress_callback, retry_policy=retry_policy)
+
+def hash_pages (payload: bytes, segment_start: int, segment_stop: int, page_hashes: dict) -> None:
+	'''
+	Hash the part of every page_size_b page of the payload that falls into the segment.
+	page_hashes is keyed by (start, stop) relative to the payload
+	'''
+	payload = memoryview(payload)
+	for page_start in range(segment_start - segment_start % page_size_b, segment_stop, page_size_b):
+		start, stop = max(page_start, segment_start), min(page_start+page_size_b, segment_stop)
+		page_hashes[(start, stop)] = hashlib.sha256(payload[start:stop]).digest()
+
+def write_memory_segments (ecu: ECU, payload: bytes, flash_start: int, segments: list[tuple[int, int]], progress_callback=False, retry_policy: RetryPolicy = memory_retry, page_hashes: dict = None) -> None:
+	'''
+	Write only the given (start, stop) ranges of the payload, 
+	one RequestDownload/TransferData/RequestTransferExit sequence per segment.
+	If page_hashes is passed, it's filled with hashes of the written pages for verify_written_pages
+	'''
+	payload = memoryview(payload)
+	for segment_start, segment_stop in segments:
+		if page_hashes is not None:
+			hash_pages(payload, segment_start, segment_stop, page_hashes)
+		write_memory(ecu, payload[segment_start:segment_stop], flash_start+segment_start, segment_stop-segment_start, progress_callback=progress_callback, retry_policy=retry_policy)
+
+def prepare_flash_plan (payload: bytes, flash_start: int, min_gap: int = default_min_blank_gap, verify: bool = False) -> FlashPlan:
+	'''
+	Trim the payload, plan its segments, hash its pages and build every packet up front.
+	Touches nothing but the payload, so it can run in a worker thread while the zone is being erased
+	'''
+	payload = memoryview(payload)
+	payload = payload[:dynamic_find_end(payload)]
+	segments = plan_segments(payload, min_gap=min_gap)
+	page_hashes = {} if verify else None
+
+	downloads = []
+	for segment_start, segment_stop in segments:
+		if page_hashes is not None:
+			hash_pages(payload, segment_start, segment_stop, page_hashes)
+		downloads.append(build_download(payload[segment_start:segment_stop], flash_start+segment_start, segment_stop-segment_start))
+
+	return FlashPlan(payload, flash_start, segments, downloads, page_hashes)
+
+def write_flash_plan (ecu: ECU, plan: FlashPlan, progress_callback=False, retry_policy: RetryPolicy = memory_retry) -> None:
+	'''
+	Send the packets of a prepared plan, nothing is built anymore at this point
+	'''
+	ecu.session.require(ecu.get_diagnostic_session_type(), access_level=AccessLevel.HYUNDAI_0x1)
+	for download in plan.downloads:
+		send_download(ecu, download, progress_callback=progress_callback, retry_policy=retry_policy)
+
+def plan_rewrite (written: bytes, readback: bytes) -> list[tuple[int, int]]:
+	'''
+	Ranges (relative to the page) that have to be written again to turn readback into written.
+	Programming flash can only clear bits, so None is returned when any byte would need 
+	a bit set back to 1 - that takes erasing the whole zone
+	'''
+	mismatches = [x for x in range(len(written)) if written[x] != readback[x]]
+	if any(readback[x] & written[x] != written[x] for x in mismatches):
+		return None
+
+	ranges = []
+	for x in mismatches:
+		start = x - x % segment_alignment
+		stop = min(start+segment_alignment, len(written))
+		if ranges and start <= ranges[-1][1]:
+			ranges[-1] = (ranges[-1][0], stop)
+		else:
+			ranges.append((start, stop))
+	return ranges
+
+def verify_written_pages (ecu: ECU, payload: bytes, flash_start: int, read_start: int, page_hashes: dict, at_a_time: int = default_transfer_size, progress_callback=False, retry_policy: RetryPolicy = memory_retry) -> VerifyResult:
+	'''
+	Read back the pages hashed by write_memory_segments and compare them against the hashes.
+	flash_start is where the payload was written to, read_start is where it can be read back from
+	(those differ for the calibration zone). Mismatching bytes that can still be programmed 
+	without an erase are written again and checked once more
+	'''
+	payload = memoryview(payload)
+	result = VerifyResult()
+	rewrites = []
+
+	for (page_start, page_stop), digest in sorted(page_hashes.items()):
+		if (progress_callback):
+			progress_callback.title('Verifying {}'.format(hex(read_start+page_start)))
+
+		failed_ranges = []
+		readback = read_range(ecu, read_start+page_start, page_stop-page_start, at_a_time=at_a_time, progress_callback=progress_callback, failed_ranges=failed_ranges, retry_policy=retry_policy)
+		if failed_ranges:
+			# gaps are filled with 0xFF, which would look like bytes that weren't written
+			logger.warning('Couldn\'t read back %s, can\'t verify it', hex(read_start+page_start))
+			result.mismatched_ranges.append((page_start, page_stop))
+			continue
+
+		if hashlib.sha256(readback).digest() == digest:
+			continue
+
+		ranges = plan_rewrite(payload[page_start:page_stop], readback)
+		if ranges is None:
+			logger.warning('Page at %s differs and can\'t be fixed without an erase', hex(read_start+page_start))
+			result.mismatched_ranges.append((page_start, page_stop))
+			continue
+
+		logger.warning('Page at %s differs, rewriting %s range(s)', hex(read_start+page_start), len(ranges))
+		rewrites += [(page_start+start, page_start+stop) for start, stop in ranges]
+
+	if rewrites:
+		write_memory_segments(ecu, payload, flash_start, rewrites, retry_policy=retry_policy)
+
+		for start, stop in rewrites:
+			readback = read_range(ecu, read_start+start, stop-start, at_a_time=at_a_time, retry_policy=retry_policy)
+			if readback == payload[start:stop]:
+				result.rewritten_ranges.append((start, stop))
+			else:
+				result.mismatched_ranges.append((start, stop))
+
+	result.mismatched_ranges = merge_ranges(result.mismatched_ranges)
+	result.rewritten_ranges = merge_ranges(result.rewritten_ranges)
+	return result
+
+def sample_pages (size: int, samples: int = default_sample_pages) -> list[tuple[int, int]]:
+	'''
+	(start, stop) of up to samples pages spread evenly over size bytes, 
+	the first and the last page are always included. samples=0 returns every page
+	'''
+	pages = [(start, min(start+page_size_b, size)) for start in range(0, size, page_size_b)]
+	if samples <= 0 or samples >= len(pages):
+		return pages
+	if samples == 1:
+		return pages[:1]
+	return [pages[round(x*(len(pages)-1)/(samples-1))] for x in range(samples)]
+
+def zone_matches (ecu: ECU, payload: bytes, read_start: int, samples: int = default_sample_pages, at_a_time: int = default_transfer_size, progress_callback=False, retry_policy: RetryPolicy = memory_retry) -> bool:
+	'''
+	Compare what the ECU holds at read_start with the payload, the whole zone
+	or only that many sampled pages. Pages that can't be read count as different.
+	Sampling can miss small changes, only use it when something else vouches for the zone
+	'''
+	payload = memoryview(payload)
+
+	for page_start, page_stop in sample_pages(len(payload), samples):
+		if (progress_callback):
+			progress_callback.title('Comparing {}'.format(hex(read_start+page_start)))
+
+		failed_ranges = []
+		readback = read_range(ecu, read_start+page_start, page_stop-page_start, at_a_time=at_a_time, progress_callback=progress_callback, failed_ranges=failed_ranges, retry_policy=retry_policy)
+		if failed_ranges or readback != payload[page_start:page_stop]:
+			logger.info('Page at %s differs from the image', hex(read_start+page_start))
+			return False
 
-	ecu.bus.execute(RequestTransferExit())
\ No newline at end of file
+	return True
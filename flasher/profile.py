@@ -0,0 +1,56 @@
+import os, json, sqlite3, logging, threading
+from contextlib import closing
+
+logger = logging.getLogger(__name__)
+
+default_profile_path = os.path.join(os.path.expanduser('~'), '.gkflasher', 'profiles.sqlite')
+
+class ProfileStore:
+	'''
+	Persistent key-value store for things we learn about ECUs and interfaces
+	at runtime (transfer sizes, page boundaries, ...). Values are stored as JSON.
+	Failing to access the store is never fatal - we just fall back to defaults
+	'''
+	def __init__ (self, path: str = default_profile_path):
+		self.path = path
+		self._lock = threading.Lock()
+
+	def _connect (self) -> sqlite3.Connection:
+		os.makedirs(os.path.dirname(self.path), exist_ok=True)
+		connection = sqlite3.connect(self.path)
+		connection.execute('CREATE TABLE IF NOT EXISTS profiles (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+		return connection
+
+	def get (self, key: str, default=None):
+		try:
+			with self._lock, closing(self._connect()) as connection:
+				row = connection.execute('SELECT value FROM profiles WHERE key = ?', (key,)).fetchone()
+		except (sqlite3.Error, OSError) as e:
+			logger.warning('Couldn\'t read profile %s from %s: %s', key, self.path, e)
+			return default
+
+		if row is None:
+			return default
+		return json.loads(row[0])
+
+	def set (self, key: str, value) -> None:
+		try:
+			with self._lock, closing(self._connect()) as connection, connection:
+				connection.execute('INSERT OR REPLACE INTO profiles (key, value) VALUES (?, ?)', (key, json.dumps(value)))
+		except (sqlite3.Error, OSError) as e:
+			logger.warning('Couldn\'t save profile %s to %s: %s', key, self.path, e)
+
+	def delete (self, key: str) -> None:
+		try:
+			with self._lock, closing(self._connect()) as connection, connection:
+				connection.execute('DELETE FROM profiles WHERE key = ?', (key,))
+		except (sqlite3.Error, OSError) as e:
+			logger.warning('Couldn\'t delete profile %s from %s: %s', key, self.path, e)
+
+profiles = ProfileStore()
+
+def ecu_profile_key (ecu, name: str) -> str:
+	return '{}/{}/{}'.format(name, ecu.get_name(), ecu.get_protocol())
+
+def identification_profile_key (fingerprint: str) -> str:
+	return 'identification/{}'.format(fingerprint)
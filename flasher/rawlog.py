@@ -0,0 +1,168 @@
+import os, csv, json, mmap, struct, time, logging
+from typing import Callable
+from .csvlog import QueuedWriter, default_fsync_interval
+
+logger = logging.getLogger(__name__)
+
+magic = b'GKRAWLOG'
+version = 2
+schema_length = struct.Struct('<L')
+# monotonic timestamp, local identifier, frame length, followed by the frame
+record_header = struct.Struct('<dBH')
+default_max_frames = 4096
+# records decode_rows decodes at a time
+default_chunk_records = 4096
+
+def source_lid (source: dict) -> int:
+	return source['payload'].get_data()[0]
+
+def parameter_layout (source: dict, parameter: dict) -> list:
+	'''
+	[local identifier, position, size] the parameter is defined at in data_sources. For a parameter
+	read from a packed local identifier that's where pack_source copied it from ('origin')
+	'''
+	lid, position = parameter.get('origin', (source_lid(source), parameter['position']))
+	return [lid, position, parameter['size']]
+
+def describe_sources (sources: list[dict]) -> list[dict]:
+	'''
+	The JSON-able part of data_sources, conversions are code and stay in flasher/logging.py.
+	Every parameter keeps its layout, so decoding can tell if the definitions changed since
+	'''
+	return [{
+		'lid': source_lid(source),
+		'parameters': [dict({key: parameter[key] for key in ('name', 'unit', 'position', 'size', 'precision')}, layout=parameter_layout(source, parameter)) for parameter in source['parameters']],
+	} for source in sources]
+
+class RawLogWriter (QueuedWriter):
+	'''
+	Append-only binary log of raw logger frames. The file starts with a magic, a JSON header
+	holding the schema and the wall clock/monotonic start times, then one record per frame:
+	record_header followed by the frame. Records are written by a background thread,
+	flushed and fsynced every fsync_interval seconds and on close, see QueuedWriter
+	'''
+	def __init__ (self, filename: str, sources: list[dict], max_frames: int = default_max_frames, fsync_interval: float = default_fsync_interval):
+		self.filename = filename
+		self.frames = 0
+
+		schema = json.dumps({
+			'version': version,
+			'started': time.time(),
+			'monotonic': time.monotonic(),
+			'sources': describe_sources(sources),
+		}).encode()
+
+		file = open(filename, 'wb')
+		file.write(magic + schema_length.pack(len(schema)) + schema)
+		super().__init__(file, max_items=max_frames, fsync_interval=fsync_interval)
+
+	def write_items (self, records: list[bytes]) -> None:
+		self.file.write(b''.join(records))
+
+	def write (self, lid: int, frame: bytes, timestamp: float = None) -> None:
+		self.put(record_header.pack(time.monotonic() if timestamp is None else timestamp, lid, len(frame)) + bytes(frame))
+		self.frames += 1
+
+class RawLogReader:
+	'''
+	Memory-mapped view of a RawLogWriter file. A record cut short at the end is ignored
+	'''
+	def __init__ (self, filename: str):
+		self.filename = filename
+		with open(filename, 'rb') as file:
+			self.mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+		if self.mapping[:len(magic)] != magic:
+			self.mapping.close()
+			raise ValueError('{} is not a raw log'.format(filename))
+
+		length, = schema_length.unpack_from(self.mapping, len(magic))
+		self.records_start = len(magic) + schema_length.size + length
+		self.header = json.loads(self.mapping[len(magic)+schema_length.size:self.records_start])
+
+	def wall_time (self, timestamp: float) -> float:
+		return self.header['started'] + (timestamp-self.header['monotonic'])
+
+	def records (self):
+		'''
+		(timestamp, lid, frame position, frame length) of every complete record, in the order they were written
+		'''
+		position = self.records_start
+		while position+record_header.size <= len(self.mapping):
+			timestamp, lid, length = record_header.unpack_from(self.mapping, position)
+			position += record_header.size
+			if position+length > len(self.mapping):
+				logger.warning('%s ends with an incomplete frame, ignoring it', self.filename)
+				break
+			yield timestamp, lid, position, length
+			position += length
+
+	def close (self) -> None:
+		self.mapping.close()
+
+	def __enter__ (self):
+		return self
+
+	def __exit__ (self, *args) -> None:
+		self.close()
+
+def column_names (decoders: list) -> list[str]:
+	return ['Unix timestamp'] + ['{} ({})'.format(parameter['name'], parameter['unit']) for decoder in decoders for parameter in decoder.parameters]
+
+def decode_records (reader: RawLogReader, decoders: dict, records: list) -> list[list]:
+	'''
+	Values of every record with the CompiledSource of its local identifier. Records are grouped
+	by local identifier and frame length, every group is decoded in one go
+	'''
+	groups = {}
+	for index, (_, lid, position, length) in enumerate(records):
+		groups.setdefault((lid, length), []).append((index, position))
+
+	values = [None]*len(records)
+	for (lid, length), group in groups.items():
+		frames = b''.join(reader.mapping[position:position+length] for _, position in group)
+		decoded = decoders[lid].decode_many(frames, length) if length else [decoders[lid].decode(b'')]*len(group)
+		for (index, _), record_values in zip(group, decoded):
+			values[index] = record_values
+	return values
+
+def decode_rows (reader: RawLogReader, decoders: list, chunk_records: int = default_chunk_records):
+	'''
+	Rows like the CSV logger writes them, decoded with the given CompiledSources (one per source
+	in the header): Unix timestamp (ms), then every parameter. A row holds the latest values of
+	every source, the ones not polled yet are None. Records are decoded chunk_records at a time,
+	so the log never has to fit in memory
+	'''
+	matched = {source_lid(decoder.source): decoder for decoder in decoders}
+	offsets, offset = {}, 0
+	for lid, decoder in matched.items():
+		offsets[lid] = offset
+		offset += len(decoder.parameters)
+	latest = [None]*offset
+
+	def rows (records: list):
+		for (timestamp, lid, _, _), values in zip(records, decode_records(reader, matched, records)):
+			latest[offsets[lid]:offsets[lid]+len(values)] = values
+			yield [int(reader.wall_time(timestamp)*1000)] + latest
+
+	chunk = []
+	for record in reader.records():
+		if record[1] not in matched:
+			continue
+		chunk.append(record)
+		if len(chunk) >= chunk_records:
+			yield from rows(chunk)
+			chunk = []
+	yield from rows(chunk)
+
+def decode_to_csv (filename: str, build_decoders: Callable, output_filename: str = None) -> str:
+	'''
+	build_decoders(header) returns the CompiledSources for the sources described in the header
+	'''
+	output_filename = output_filename or os.path.splitext(filename)[0] + '.csv'
+	with RawLogReader(filename) as reader, open(output_filename, 'w', newline='') as csvfile:
+		decoders = build_decoders(reader.header)
+		logwriter = csv.writer(csvfile)
+		logwriter.writerow(column_names(decoders))
+		logwriter.writerows(decode_rows(reader, decoders))
+	return output_filename
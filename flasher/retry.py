@@ -0,0 +1,86 @@
+import time, logging
+from dataclasses import dataclass, field
+from typing import Callable
+from gkbus.protocol import kwp2000
+from gkbus.hardware import TimeoutException
+
+logger = logging.getLogger(__name__)
+
+def log_retry (policy: 'RetryPolicy', attempt: int, exception: Exception) -> None:
+	logger.warning('%s: attempt %s/%s failed (%s), retrying', policy.name, attempt, policy.max_attempts, exception.__class__.__name__)
+
+# negative responses that only mean "not now", anything else (out of range, restricted address,
+# security access denied...) gets the same answer however often it's asked
+retryable_statuses = (
+	kwp2000.Kwp2000NegativeStatusIdentifierEnum.BUSY_REPEAT_REQUEST.value,
+	kwp2000.Kwp2000NegativeStatusIdentifierEnum.CONDITIONS_NOT_CORRECT_OR_REQUEST_SEQUENCE_ERROR.value,
+	kwp2000.Kwp2000NegativeStatusIdentifierEnum.REQUEST_CORRECTLY_RECEIVED_RESPONSE_PENDING.value,
+)
+
+@dataclass
+class RetryPolicy:
+	'''
+	Retries an operation that raised one of the given exceptions. Gives up after max_attempts
+	or once the next attempt would start after budget seconds, re-raising the last exception.
+	Sleeps backoff seconds before the first retry, multiplied by multiplier every time (up to max_backoff).
+	on_retry(policy, attempt, exception) is called before every retry. A negative response is
+	only retried if its status is one of retryable_statuses, otherwise it's re-raised right away
+	'''
+	name: str
+	max_attempts: int = 5
+	backoff: float = 0.1
+	multiplier: float = 2
+	max_backoff: float = 2
+	budget: float = 30
+	exceptions: tuple = (TimeoutException,)
+	retryable_statuses: tuple = retryable_statuses
+	on_retry: Callable = log_retry
+
+	calls: int = field(default=0, init=False)
+	attempts: int = field(default=0, init=False)
+	retries: int = field(default=0, init=False)
+	failures: int = field(default=0, init=False)
+
+	def retryable (self, exception: Exception) -> bool:
+		if isinstance(exception, kwp2000.Kwp2000NegativeResponseException):
+			return exception.status.identifier in self.retryable_statuses
+		return True
+
+	def call (self, fn: Callable, *args, **kwargs):
+		started = time.monotonic()
+		delay = self.backoff
+		self.calls += 1
+
+		for attempt in range(1, self.max_attempts+1):
+			self.attempts += 1
+			try:
+				return fn(*args, **kwargs)
+			except self.exceptions as e:
+				elapsed = time.monotonic()-started
+				if not self.retryable(e):
+					self.failures += 1
+					raise
+				if attempt == self.max_attempts or (elapsed+delay) > self.budget:
+					self.failures += 1
+					logger.warning('%s: giving up after %s attempt(s) and %.1fs', self.name, attempt, elapsed)
+					raise
+
+				self.retries += 1
+				if self.on_retry:
+					self.on_retry(self, attempt, e)
+				time.sleep(delay)
+				delay = min(delay*self.multiplier, self.max_backoff)
+
+	def get_counters (self) -> dict:
+		return {'calls': self.calls, 'attempts': self.attempts, 'retries': self.retries, 'failures': self.failures}
+
+	def reset_counters (self) -> None:
+		self.calls, self.attempts, self.retries, self.failures = 0, 0, 0, 0
+
+# shared policies, one per layer so their counters can be told apart
+memory_retry = RetryPolicy('memory', max_attempts=5, budget=30)
+identification_retry = RetryPolicy('identification', max_attempts=3, budget=10)
+logger_retry = RetryPolicy('logger', max_attempts=3, backoff=0.05, budget=5)
+
+def get_retry_counters () -> dict:
+	return {policy.name: policy.get_counters() for policy in (memory_retry, identification_retry, logger_retry)}
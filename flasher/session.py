@@ -0,0 +1,50 @@
+import logging
+from gkbus.protocol import kwp2000
+from ecu_definitions import AccessLevel
+
+logger = logging.getLogger(__name__)
+
+class SessionManager:
+	'''
+	Keeps track of the diagnostic session, baudrate index and security level the ECU is in.
+	Operations say what they need with require() and only the transitions
+	that are actually missing get sent. State is None while unknown. Starting a session
+	drops the security level, the ECU forgets it too
+	'''
+	session: kwp2000.enums.DiagnosticSession
+	baudrate_index: int
+	access_level: AccessLevel
+
+	def __init__ (self, ecu):
+		self.ecu = ecu
+		self.session, self.baudrate_index, self.access_level = None, None, None
+		self.transitions = 0
+
+	def assume (self, session: kwp2000.enums.DiagnosticSession, baudrate_index: int = None, access_level: AccessLevel = None) -> None:
+		'''
+		Record a state that was reached without the manager, like the session started before identification
+		'''
+		self.session, self.baudrate_index, self.access_level = session, baudrate_index, access_level
+
+	def invalidate (self) -> None:
+		'''
+		Forget the state, for example after ECUReset
+		'''
+		self.session, self.baudrate_index, self.access_level = None, None, None
+
+	def require (self, session: kwp2000.enums.DiagnosticSession, access_level: AccessLevel = None) -> None:
+		desired_baudrate = self.ecu.get_desired_baudrate()
+
+		if session != self.session or desired_baudrate.index != self.baudrate_index:
+			logger.debug('Switching session from %s to %s', self.session, session)
+			self.ecu.bus.execute(kwp2000.commands.StartDiagnosticSession(session, desired_baudrate.index))
+			if desired_baudrate.index != self.baudrate_index:
+				self.ecu.bus.transport.hardware.set_baudrate(desired_baudrate.baudrate)
+			self.session, self.baudrate_index, self.access_level = session, desired_baudrate.index, None
+			self.transitions += 1
+
+		if access_level is not None and access_level != self.access_level:
+			self.ecu.security_access(access_level)
+
+	def set_access_level (self, access_level: AccessLevel) -> None:
+		self.access_level = access_level
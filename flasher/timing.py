@@ -0,0 +1,100 @@
+import time, logging
+from gkbus.protocol import kwp2000
+from gkbus.hardware import TimeoutException
+from .ecu import ECU
+from .memory import default_transfer_size
+from .profile import profiles, ecu_profile_key
+
+logger = logging.getLogger(__name__)
+
+# ISO 14230 defaults as sent in AccessTimingParameters: P2min 25ms, P2max 50ms, P3min 55ms, P3max 5s, P4min 5ms
+default_timing = [50, 2, 110, 20, 10]
+# how far each candidate steps P2min and P3min back from the limits towards the defaults
+timing_fractions = [0, 0.25, 0.5, 1]
+default_benchmark_requests = 16
+
+def read_timing_limits (bus: kwp2000.Kwp2000Protocol) -> list[int]:
+	'''
+	P2min, P2max, P3min, P3max, P4min limits reported by the ECU, in the AccessTimingParameters encoding
+	'''
+	return list(bus.execute(kwp2000.commands.AccessTimingParameters().read_limits_of_possible_timing_parameters()).get_data()[1:6])
+
+def set_timing (bus: kwp2000.Kwp2000Protocol, timing: list[int]) -> None:
+	bus.execute(kwp2000.commands.AccessTimingParameters().set_timing_parameters_to_given_values(*timing))
+
+def timing_candidates (limits: list[int]) -> list[list[int]]:
+	'''
+	The limits first, then P2min and P3min stepped back towards the defaults.
+	P2max, P3max and P4min stay at the limits, they only decide how long
+	either side waits before giving up
+	'''
+	candidates = []
+	for fraction in timing_fractions:
+		candidate = list(limits)
+		for parameter in (0, 2): # P2min, P3min
+			candidate[parameter] = round(limits[parameter] + (default_timing[parameter]-limits[parameter])*fraction)
+		if candidate not in candidates:
+			candidates.append(candidate)
+	return candidates
+
+def benchmark_timing (ecu: ECU, timing: list[int], requests: int = default_benchmark_requests) -> tuple[float, int]:
+	'''
+	Apply the timing set and time a fixed ReadMemoryByAddress workload at the calibration zone.
+	Returns seconds per request and the amount of failed requests
+	'''
+	set_timing(ecu.bus, timing)
+
+	size = default_transfer_size
+	errors = 0
+	started = time.monotonic()
+	for _ in range(requests):
+		try:
+			ecu.bus.execute(kwp2000.commands.ReadMemoryByAddress(offset=ecu.get_calibration_section_address(), size=size))
+		except (kwp2000.Kwp2000NegativeResponseException, TimeoutException):
+			errors += 1
+
+	return (time.monotonic()-started)/requests, errors
+
+def calibrate_timing (ecu: ECU, requests: int = default_benchmark_requests) -> list[int]:
+	'''
+	Benchmark every candidate timing set and keep the fastest one without errors.
+	The winner is applied and stored for this ECU type. Returns None if none of them worked
+	'''
+	results = []
+	for timing in timing_candidates(read_timing_limits(ecu.bus)):
+		try:
+			latency, errors = benchmark_timing(ecu, timing, requests=requests)
+		except (kwp2000.Kwp2000NegativeResponseException, TimeoutException) as e:
+			logger.info('Timing %s rejected: %s', timing, e.__class__.__name__)
+			continue
+
+		logger.info('Timing %s: %.1f ms per request, %s error(s)', timing, latency*1000, errors)
+		if errors == 0:
+			results.append((latency, timing))
+
+	if not results:
+		logger.warning('No timing set worked without errors, going back to the defaults')
+		ecu.bus.execute(kwp2000.commands.AccessTimingParameters().set_timing_parameters_to_default_values())
+		return None
+
+	latency, timing = min(results)
+	set_timing(ecu.bus, timing)
+	profiles.set(ecu_profile_key(ecu, 'timing'), timing)
+	return timing
+
+def apply_timing (ecu: ECU) -> list[int]:
+	'''
+	Apply the timing set calibrated for this ECU type, if there is one. Returns it,
+	or None if there's none stored or the ECU doesn't take it anymore
+	'''
+	timing = profiles.get(ecu_profile_key(ecu, 'timing'))
+	if not timing:
+		return None
+
+	try:
+		set_timing(ecu.bus, timing)
+	except kwp2000.Kwp2000NegativeResponseException as e:
+		logger.warning('Stored timing %s rejected, staying with the limits: %s', timing, e)
+		set_timing(ecu.bus, read_timing_limits(ecu.bus))
+		return None
+	return timing
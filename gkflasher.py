@@ -1,22 +1,53 @@
-import argparse, time, yaml, logging, sys, os, traceback
+import argparse, time, yaml, logging, sys, os, traceback, threading
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from alive_progress import alive_bar
 from gkbus.hardware import KLineHardware, CanHardware, OpeningPortException, TimeoutException
 from gkbus.transport import Kwp2000OverKLineTransport, Kwp2000OverCanTransport, RawPacket, PacketDirection
 from gkbus.protocol import kwp2000
-from flasher.memory import read_memory, write_memory, dynamic_find_end
-from flasher.ecu import ECU, identify_ecu, fetch_ecu_identification, enable_security_access, ECUIdentificationException, DesiredBaudrate
+from flasher.memory import read_memory, MappedDump, verify_written_pages, zone_matches, prepare_flash_plan, write_flash_plan, default_min_blank_gap, default_sample_pages
+from flasher.journal import PageJournal
+from flasher.ecu import ECU, identify_ecu, verify_ecu, fetch_ecu_identification, fetch_ecu_fingerprint, load_identification, save_identification, enable_security_access, ECUIdentificationException, DesiredBaudrate
 from flasher.checksum import correct_checksum
 from ecu_definitions import ECU_IDENTIFICATION_TABLE, BAUDRATES, Routine, ReprogrammingStatus, AccessLevel
-from flasher.logging import logger, logger_raw
+from flasher.logging import logger, logger_raw, decode_raw_log
 from flasher.immo import cli_immo, cli_immo_info
 from flasher.lineswap import generate_sie, generate_bin
+from flasher.retry import get_retry_counters
+from flasher.keepalive import KeepalivePolicy, get_keepalive_counters
+from flasher.baudrate import negotiate_baudrate, start_session_at
+from flasher.timing import calibrate_timing, apply_timing
+from flasher.fleet import Bench, BenchResult, JobFailed, parse_fleet, run_fleet, format_summary, TrafficMeter
 from _version import __version__
 
+# fleet mode runs unattended: questions are answered with yes and progress bars are off
+assume_yes = False
+progress_enabled = True
+
+class OperationFailed (Exception):
+	'''
+	Raised by main() once everything asked for has run on ecu, when some of it didn't succeed
+	'''
+	def __init__ (self, message: str, ecu: ECU):
+		super().__init__(message)
+		self.ecu = ecu
+
 def strip (string):
 	return ''.join(x for x in string if x.isalnum())
 
-def cli_read_eeprom (ecu: ECU, eeprom_size: int, address_start: int = None, address_stop: int = None, escalate_privileges: bool = False, output_filename: str = None):
+def confirm (question: str) -> bool:
+	if assume_yes:
+		print('{}y'.format(question))
+		return True
+	return input(question) == 'y'
+
+def progress_bar (total: int):
+	return alive_bar(total, unit='B', disable=not progress_enabled)
+
+def cli_read_eeprom (ecu: ECU, eeprom_size: int, address_start: int = None, address_stop: int = None, escalate_privileges: bool = False, output_filename: str = None, bench: str = None) -> bool:
+	'''
+	Returns whether the whole range was read, restricted ranges aside
+	'''
 	if escalate_privileges:
 		print('[*] Attempting privilege escalation with the IOCLID patch')
 		if (ecu.security_access(AccessLevel.SIEMENS_0xFD)):
@@ -35,79 +66,189 @@ def cli_read_eeprom (ecu: ECU, eeprom_size: int, address_start: int = None, addr
 
 	print('[*] Reading from {} to {}'.format(hex(address_start), hex(address_stop)))
 
-	requested_size = address_stop-address_start
-	eeprom = bytearray([0xFF]*eeprom_size)
-
-	with alive_bar(requested_size, unit='B') as bar:
-		fetched = read_memory(ecu, address_start=address_start, address_stop=address_stop, progress_callback=bar)
+	try:
+		calibration = ecu.get_calibration()
+	except (kwp2000.Kwp2000NegativeResponseException, TimeoutException):
+		calibration = None
 
-	eeprom_start = ecu.calculate_bin_offset(address_start)
-	eeprom_end = eeprom_start + len(fetched)
-	eeprom[eeprom_start:eeprom_end] = fetched
+	# benches in fleet mode can hold identical ECUs, they each get their own journal and dump
+	journal = PageJournal(PageJournal.filename('{}_{}'.format(bench, ecu.get_name()) if bench else ecu.get_name(), calibration or 'unknown', address_start, address_stop))
+	if len(journal):
+		print('[*] Resuming an interrupted read, {} pages already fetched in {}'.format(len(journal), journal.path))
 
 	if (output_filename == None):
 		try:
-			calibration = ecu.get_calibration()
+			if calibration is None:
+				raise ValueError('calibration unknown')
 			description = ecu.get_calibration_description()
-			hw_rev_c = strip(''.join([chr(x) for x in list(ecu.bus.execute(kwp2000.commands.ReadEcuIdentification(0x8c)).get_data())[1:]]))
-			hw_rev_d = strip(''.join([chr(x) for x in list(ecu.bus.execute(kwp2000.commands.ReadEcuIdentification(0x8d)).get_data())[1:]]))
+			hw_rev_c = strip(''.join([chr(x) for x in ecu.get_identification(0x8c)]))
+			hw_rev_d = strip(''.join([chr(x) for x in ecu.get_identification(0x8d)]))
 			output_filename = "{}_{}_{}_{}_{}.bin".format(description, calibration, hw_rev_c, hw_rev_d, datetime.now().strftime('%Y-%m-%d_%H%M'))
 		except: # dirty
 			output_filename = "output_{}_to_{}.bin".format(hex(address_start), hex(address_stop))
 
-	with open (output_filename, "wb") as file:
-		file.write(bytes(eeprom))
+	if bench:
+		output_filename = os.path.join(os.path.dirname(output_filename), '{}_{}'.format(bench, os.path.basename(output_filename)))
+
+	requested_size = address_stop-address_start
+	eeprom_start = ecu.calculate_bin_offset(address_start)
+	eeprom_end = eeprom_start + requested_size
+
+	# the dump is written in place as pages come in
+	dump = MappedDump(output_filename, max(eeprom_size, eeprom_end))
+	with dump as eeprom, eeprom[eeprom_start:eeprom_end] as buffer:
+		with progress_bar(requested_size) as bar:
+			result = read_memory(ecu, address_start=address_start, address_stop=address_stop, progress_callback=bar, journal=journal, buffer=buffer)
+		if result.interrupted:
+			dump.discard()
+
+	if result.interrupted:
+		print('[!] Read interrupted! {} pages are saved in {}, {} is incomplete'.format(len(journal), journal.path, dump.part_filename))
+		print('    Run the same read again to resume.')
+		return False
 
 	print('[*] saved to {}'.format(output_filename))
 
+	if result.restricted_ranges:
+		print('[*] {} restricted range(s) are filled with 0xFF:'.format(len(result.restricted_ranges)))
+		for restricted_start, restricted_stop in result.restricted_ranges:
+			print('    {} - {}'.format(hex(restricted_start), hex(restricted_stop)))
+
+	if result.failed_ranges:
+		print('[!] {} range(s) couldn\'t be read and are filled with 0xFF:'.format(len(result.failed_ranges)))
+		for failed_start, failed_stop in result.failed_ranges:
+			print('    {} - {}'.format(hex(failed_start), hex(failed_stop)))
+		print('    Run the same read again to retry just the affected pages.')
+		return False
+
+	journal.remove()
 	print('[*] Done!')
+	return True
+
+def cli_verify_zone (ecu: ECU, payload, flash_start: int, read_start: int, page_hashes: dict) -> bool:
+	verify_size = sum(page_stop-page_start for page_start, page_stop in page_hashes)
+	print('[*] Reading back {} bytes to verify'.format(verify_size))
+
+	with progress_bar(verify_size) as bar:
+		result = verify_written_pages(ecu, payload, flash_start, read_start, page_hashes, progress_callback=bar)
 
-def cli_flash_eeprom (ecu, input_filename, flash_calibration=True, flash_program=True):
+	for rewritten_start, rewritten_stop in result.rewritten_ranges:
+		print('[*] Rewrote {} - {}'.format(hex(read_start+rewritten_start), hex(read_start+rewritten_stop)))
+
+	if not result.success():
+		print('[!] {} range(s) don\'t match the file:'.format(len(result.mismatched_ranges)))
+		for mismatched_start, mismatched_stop in result.mismatched_ranges:
+			print('    {} - {}'.format(hex(read_start+mismatched_start), hex(read_start+mismatched_stop)))
+		print('    Flash the zone again.')
+		return False
+
+	print('[*] Verified!')
+	return True
+
+# identification values shorter than this turn up in any image by chance, they don't tell anything
+min_identification_length = 4
+
+def cli_program_unchanged (ecu: ECU, eeprom, samples: int = default_sample_pages) -> bool:
+	print('[*] Comparing the image with what\'s on the ECU')
+
+	calibration_start = ecu.calculate_bin_offset(ecu.get_calibration_section_address())
+	image_calibration = ''.join([chr(x) for x in eeprom[calibration_start:calibration_start+8]])
+	try:
+		print('    Calibration: {} on the ECU, {} in the image'.format(ecu.get_calibration(), image_calibration))
+	except (kwp2000.Kwp2000NegativeResponseException, TimeoutException):
+		print('    Calibration: unknown on the ECU, {} in the image'.format(image_calibration))
+
+	# the verification number and fingerprints are stored with what they describe, one the image
+	# doesn't hold means the ECU runs something else and there's no point in reading it to be sure
+	image = bytes(eeprom)
+	for parameter_key, parameter in fetch_ecu_identification(ecu.bus, parameters=[0x97, 0x9A, 0x9B]).items():
+		value = bytes(parameter['value'])
+		print('    [{}] {}: {}'.format(hex(parameter_key), parameter['name'], ' '.join([hex(x) for x in value])))
+		if len(value.strip(b'\x00\xFF')) < min_identification_length:
+			continue
+		if value not in image:
+			print('[*] {} isn\'t in the image'.format(parameter['name']))
+			return False
+
+	# the flag in the first 16 bytes isn't ours to write, so it's not compared either
+	payload_start = ecu.calculate_bin_offset(ecu.get_program_section_address()) + 16
+	payload = eeprom[payload_start:payload_start+ecu.get_program_section_size()-16]
+
+	if samples:
+		print('[*] Comparing {} sampled pages of the program zone'.format(samples))
+
+	return zone_matches(ecu, payload, ecu.get_program_section_address()+16, samples=samples)
+
+def cli_flash_eeprom (ecu, input_filename, flash_calibration=True, flash_program=True, min_blank_gap=default_min_blank_gap, verify=False, skip_unchanged=False, skip_unchanged_samples=default_sample_pages) -> bool:
+	'''
+	Returns whether everything written was verified (if asked to) and the ECU accepted the blocks
+	'''
 	print('\n[*] Loading up {}'.format(input_filename))
 
 	with open(input_filename, 'rb') as file:
-		eeprom = file.read()
+		eeprom = memoryview(file.read()) # zone payloads are sliced out as views, not copies
 
 	print('[*] Loaded {} bytes'.format(len(eeprom)))
 
-	if (input('[?] Ready to flash! Do you wish to continue? [y/n]: ') != 'y'):
+	if flash_program and skip_unchanged:
+		if cli_program_unchanged(ecu, eeprom, samples=skip_unchanged_samples):
+			print('[*] Program zone matches the image, it won\'t be erased or written')
+			flash_program = False
+		else:
+			print('[*] Program zone differs from the image, flashing it')
+
+	if not confirm('[?] Ready to flash! Do you wish to continue? [y/n]: '):
 		print('[!] Aborting!')
-		return
+		return False
 
-	if flash_program:
-		print('[*] start routine 0x00 (erase program code section)')
-		ecu.bus.execute(kwp2000.commands.StartRoutineByLocalIdentifier(Routine.ERASE_PROGRAM.value))
+	unverified = []
 
+	# packets are built in the background while the ECU is busy erasing
+	with ThreadPoolExecutor(max_workers=1) as executor:
+		if flash_program:
+			# we need to start 16 bytes later as the program section starts with a flag that we can't write
+			payload_start = ecu.calculate_bin_offset(ecu.get_program_section_address()) + 16
+			program_plan = executor.submit(prepare_flash_plan, eeprom[payload_start:(payload_start+ecu.get_program_section_size()-16)], ecu.get_program_section_address() + 16, min_gap=min_blank_gap, verify=verify)
 
-		# we need to start 16 bytes later as the program section starts with a flag that we can't write
-		payload_start = ecu.calculate_bin_offset(ecu.get_program_section_address()) + 16
-		payload_stop = payload_start + dynamic_find_end(eeprom[payload_start:(payload_start+ecu.get_program_section_size()-16)])
-		payload = eeprom[payload_start:payload_stop]
+		if flash_calibration:
+			payload_start = ecu.calculate_bin_offset(ecu.get_calibration_section_address())
+			# we need to shave 16 bytes off the top as this is where a flag that we can't write is located
+			calibration_plan = executor.submit(prepare_flash_plan, eeprom[payload_start:(payload_start+ecu.get_calibration_size_bytes()-16)], ecu.calculate_memory_write_offset(ecu.get_calibration_section_address()), min_gap=min_blank_gap, verify=verify)
 
-		flash_start = ecu.get_program_section_address() + 16
-		flash_size = payload_stop-payload_start
+		ecu.session.require(ecu.get_diagnostic_session_type(), access_level=AccessLevel.HYUNDAI_0x1)
 
-		with alive_bar(flash_size, unit='B') as bar:
-			write_memory(ecu, payload, flash_start, flash_size, progress_callback=bar)
+		if flash_program:
+			print('[*] start routine 0x00 (erase program code section)')
+			ecu.bus.execute(kwp2000.commands.StartRoutineByLocalIdentifier(Routine.ERASE_PROGRAM.value))
 
-	if flash_calibration:
-		print('[*] start routine 0x01 (erase calibration section)')
-		ecu.bus.execute(kwp2000.commands.StartRoutineByLocalIdentifier(Routine.ERASE_CALIBRATION.value))
+			plan = program_plan.result()
+			print('[*] Writing {} of {} bytes in {} segment(s)'.format(plan.flash_size(), len(plan.payload), len(plan.segments)))
 
-		payload_start = ecu.calculate_bin_offset(ecu.get_calibration_section_address())
-		# we need to shave 16 bytes off the top as this is where a flag that we can't write is located
-		payload_stop = payload_start + dynamic_find_end(eeprom[payload_start:(payload_start+ecu.get_calibration_size_bytes()-16)])
-		payload = eeprom[payload_start:payload_stop]
+			with progress_bar(plan.flash_size()) as bar:
+				write_flash_plan(ecu, plan, progress_callback=bar)
 
-		flash_start = ecu.calculate_memory_write_offset(ecu.get_calibration_section_address())
-		flash_size = payload_stop-payload_start
+			if verify and not cli_verify_zone(ecu, plan.payload, plan.flash_start, plan.flash_start, plan.page_hashes):
+				unverified.append('program')
 
-		with alive_bar(flash_size, unit='B') as bar:
-			write_memory(ecu, payload, flash_start, flash_size, progress_callback=bar)
+		if flash_calibration:
+			print('[*] start routine 0x01 (erase calibration section)')
+			ecu.bus.execute(kwp2000.commands.StartRoutineByLocalIdentifier(Routine.ERASE_CALIBRATION.value))
+
+			plan = calibration_plan.result()
+			print('[*] Writing {} of {} bytes in {} segment(s)'.format(plan.flash_size(), len(plan.payload), len(plan.segments)))
+
+			with progress_bar(plan.flash_size()) as bar:
+				write_flash_plan(ecu, plan, progress_callback=bar)
+
+			if verify:
+				# the calibration zone is written through a different address than it's read from
+				if not cli_verify_zone(ecu, plan.payload, plan.flash_start, ecu.get_calibration_section_address(), plan.page_hashes):
+					unverified.append('calibration')
 
 	ecu.bus.transport.hardware.set_timeout(300)
 
 	print('[*] start routine 0x02 (verify blocks and mark as ready to execute)')
+	bricked = False
 	try:
 		ecu.bus.execute(kwp2000.commands.StartRoutineByLocalIdentifier(Routine.VERIFY_BLOCKS.value))
 	except kwp2000.Kwp2000NegativeResponseException as e:
@@ -124,14 +265,21 @@ def cli_flash_eeprom (ecu, input_filename, flash_calibration=True, flash_program
 		print(str(reprogramming_status))
 
 		print('[!] Your ECU is now soft-bricked. There\'s no need to panic, all you need to do is flash a valid file.')
+		bricked = True
 
 	ecu.bus.transport.hardware.set_timeout(12)
+	ecu.forget_identification()
 
 	print('[*] ecu reset')
 	print('[*] done!')
 	ecu.bus.execute(kwp2000.commands.ECUReset(kwp2000.enums.ResetMode.POWER_ON_RESET)).get_data()
+	ecu.session.invalidate()
 	ecu.bus.close()
-	
+
+	if unverified:
+		print('[!] The {} zone(s) don\'t match {}, flash them again'.format(' and '.join(unverified), input_filename))
+	return not unverified and not bricked
+
 def cli_clear_adaptive_values (ecu):
 	print('[*] Clearing adaptive values.. ', end='')
 	ecu.clear_adaptive_values()
@@ -145,25 +293,35 @@ def load_arguments ():
 	parser.add_argument('-p', '--protocol', help='Protocol to use. canbus or kline')
 	parser.add_argument('-i', '--interface')
 	parser.add_argument('-b', '--baudrate', type=int)
-	parser.add_argument('--desired-baudrate', type=lambda x: int(x,0))
+	parser.add_argument('--desired-baudrate', type=lambda x: x if x == 'auto' else int(x,0), help='Baudrate index to switch to, or auto to find the fastest stable one')
 	parser.add_argument('-f', '--flash', help='Filename to full flash')
 	parser.add_argument('--flash-calibration', help='Filename to flash calibration zone from')
 	parser.add_argument('--flash-program', help='Filename to flash program zone from')
+	parser.add_argument('--min-blank-gap', type=lambda x: int(x,0), default=default_min_blank_gap, help='Skip runs of 0xFF at least this long when flashing. 0 to write everything')
+	parser.add_argument('--verify', action='store_true', help='Read back written pages after flashing and rewrite the ones that don\'t match')
+	parser.add_argument('--skip-unchanged', action='store_true', help='Don\'t erase and write the program zone if the ECU already holds the same one')
+	parser.add_argument('--skip-unchanged-samples', type=int, default=default_sample_pages, help='How many sampled pages of the program zone --skip-unchanged compares, 0 for all of them. Sampling can miss small patches')
 	parser.add_argument('-r', '--read', action='store_true')
 	parser.add_argument('--read-calibration', action='store_true')
 	parser.add_argument('--read-program', action='store_true')
+	parser.add_argument('--calibrate-timing', action='store_true', help='Benchmark a few timing parameter sets and keep the fastest one that works without errors')
 	parser.add_argument('--id', action='store_true')
 	parser.add_argument('--correct-checksum')
 	parser.add_argument('--bin-to-sie')
 	parser.add_argument('--sie-to-bin')	
 	parser.add_argument('--clear-adaptive-values', action='store_true')
 	parser.add_argument('-l', '--logger', action='store_true')
+	parser.add_argument('--channels', type=lambda x: x.split(','), help='Comma separated logger channels to log instead of all of them, read through a local identifier holding only their bytes')
+	parser.add_argument('--logger-raw', action='store_true', help='Log raw frames into a binary file, to be decoded later with --decode-log')
+	parser.add_argument('--decode-log', help='Decode a raw log into CSV')
 	parser.add_argument('-o', '--output', help='Filename to save the EEPROM dump')
 	parser.add_argument('-s', '--address-start', help='Offset to start reading/flashing from.', type=lambda x: int(x,0))
 	parser.add_argument('-e', '--address-stop', help='Offset to stop reading/flashing at.', type=lambda x: int(x,0))
 	parser.add_argument('-c', '--config', help='Config filename', default='gkflasher.yml')
 	parser.add_argument('-v', '--verbose', action='count', default=0)
 	parser.add_argument('--immo', action='store_true')
+	parser.add_argument('-y', '--yes', action='store_true', help='Answer yes to every question')
+	parser.add_argument('--fleet', help='Run the same job on several benches at once, like kline:/dev/ttyUSB0,kline:/dev/ttyUSB1,canbus:can0')
 	args = parser.parse_args()
 
 	logging_levels = [logging.WARNING, logging.INFO, logging.DEBUG]
@@ -199,6 +357,10 @@ def cli_choose_ecu ():
 	for index, ecu in enumerate(ECU_IDENTIFICATION_TABLE):
 		print('    [{}] {}'.format(index, ecu['ecu']['name']))
 
+	if assume_yes:
+		print('[!] Running unattended, aborting..')
+		return
+
 	try:
 		choice = int(input('ECU or any other char to abort: '))
 	except ValueError:
@@ -213,11 +375,22 @@ def cli_choose_ecu ():
 
 	return ECU_IDENTIFICATION_TABLE[choice]
 
-def cli_identify_ecu (bus: kwp2000.Kwp2000Protocol):
+def cli_identify_ecu (bus: kwp2000.Kwp2000Protocol, fingerprint: str = None):
+	known_ecu = load_identification(fingerprint).get('ecu')
+	if known_ecu:
+		# the fingerprint doesn't change with a reflash, so the cached ECU is checked once before it's trusted
+		ecu = verify_ecu(bus, known_ecu)
+		if ecu:
+			ecu.set_fingerprint(fingerprint)
+			print('[*] Known car! {}'.format(ecu.get_name()))
+			return ecu
+		print('[!] This car was a {} last time, but it doesn\'t match anymore'.format(known_ecu))
+
 	print('[*] Trying to identify ECU automatically.. ')
 	
 	try:
 		ecu = identify_ecu(bus)
+		save_identification(fingerprint, ecu=ecu.get_name())
 	except ECUIdentificationException:
 		choice = cli_choose_ecu()
 		if not choice:
@@ -225,16 +398,21 @@ def cli_identify_ecu (bus: kwp2000.Kwp2000Protocol):
 		ecu = ECU(**choice['ecu'])
 		ecu.set_bus(bus)
 
+	ecu.set_fingerprint(fingerprint)
 	print('[*] Found! {}'.format(ecu.get_name()))
 	return ecu
 
-def main(bus: kwp2000.Kwp2000Protocol, args):
-	bus.init(kwp2000.commands.StartCommunication(), keepalive_command=kwp2000.commands.TesterPresent(kwp2000.enums.ResponseType.REQUIRED), keepalive_delay=1.5)
+def main(bus: kwp2000.Kwp2000Protocol, args, bench: str = None):
+	bus.init(kwp2000.commands.StartCommunication())
+	KeepalivePolicy(bus, kwp2000.commands.TesterPresent(kwp2000.enums.ResponseType.REQUIRED), delay=1.5).start()
 	bus.transport.set_buffer_size(20)
 
-	if args.desired_baudrate:
+	# auto starts at 10400 and negotiates once the ECU is identified
+	desired_baudrate_index = None if args.desired_baudrate == 'auto' else args.desired_baudrate
+
+	if desired_baudrate_index:
 		try:
-			desired_baudrate = DesiredBaudrate(index=args.desired_baudrate, baudrate=BAUDRATES[args.desired_baudrate])
+			desired_baudrate = DesiredBaudrate(index=desired_baudrate_index, baudrate=BAUDRATES[desired_baudrate_index])
 		except KeyError:
 			print('[!] Selected baudrate is invalid! Available baudrates:')
 			for key, baudrate in BAUDRATES.items():
@@ -242,21 +420,30 @@ def main(bus: kwp2000.Kwp2000Protocol, args):
 			return
 
 		print('[*] Trying to start diagnostic session with baudrate {}'.format(desired_baudrate.baudrate))
-		try:
-			bus.execute(kwp2000.commands.StartDiagnosticSession(kwp2000.enums.DiagnosticSession.FLASH_REPROGRAMMING, desired_baudrate.index))
-			bus.transport.hardware.set_baudrate(desired_baudrate.baudrate)
-		except TimeoutException:
-			# it's possible that the bus is already running at the desired baudrate - let's check
-			bus.transport.hardware.socket.reset_input_buffer() # @todo: expose this in public gkbus api
-			bus.transport.hardware.socket.reset_output_buffer()
-			bus.transport.hardware.set_baudrate(desired_baudrate.baudrate)
-			bus.execute(kwp2000.commands.StartDiagnosticSession(kwp2000.enums.DiagnosticSession.FLASH_REPROGRAMMING, desired_baudrate.index))
+		start_session_at(bus, desired_baudrate)
 	else:
 		# @todo: not ideal, but its a bridge towards moving this completely to the ECU class. it was a mess
 		desired_baudrate = DesiredBaudrate(index=None, baudrate=10400)
 		print('[*] Trying to start diagnostic session')
 		bus.execute(kwp2000.commands.StartDiagnosticSession(kwp2000.enums.DiagnosticSession.FLASH_REPROGRAMMING))
-		
+
+	# cars seen before are recognized by fingerprint, so the identification doesn't have to be done again.
+	# it's read in the diagnostic session, not every ECU answers before it's started
+	fingerprint = fetch_ecu_fingerprint(bus)
+	known_baudrate = load_identification(fingerprint).get('baudrate')
+
+	if desired_baudrate_index:
+		save_identification(fingerprint, baudrate=desired_baudrate.index)
+	elif args.desired_baudrate is None and known_baudrate in BAUDRATES and known_baudrate != 0x01:
+		print('[*] Known car, switching to the baudrate that worked last time ({})'.format(BAUDRATES[known_baudrate]))
+		try:
+			start_session_at(bus, DesiredBaudrate(index=known_baudrate, baudrate=BAUDRATES[known_baudrate]))
+			desired_baudrate = DesiredBaudrate(index=known_baudrate, baudrate=BAUDRATES[known_baudrate])
+		except (kwp2000.Kwp2000NegativeResponseException, TimeoutException):
+			print('[!] It doesn\'t work anymore, staying at 10400')
+			bus.transport.hardware.set_baudrate(desired_baudrate.baudrate)
+			bus.execute(kwp2000.commands.StartDiagnosticSession(kwp2000.enums.DiagnosticSession.FLASH_REPROGRAMMING))
+
 	bus.transport.hardware.set_timeout(12)
 
 	print('[*] Set timing parameters to maximum')
@@ -280,13 +467,29 @@ def main(bus: kwp2000.Kwp2000Protocol, args):
 	print('[*] Security Access')
 	enable_security_access(bus)
 
-	ecu = cli_identify_ecu(bus)
+	ecu = cli_identify_ecu(bus, fingerprint)
 	if not ecu:
 		return
 
 	ecu.set_desired_baudrate(desired_baudrate)
 	ecu.diagnostic_session_type = kwp2000.enums.DiagnosticSession.FLASH_REPROGRAMMING
 	ecu.access_level = AccessLevel.HYUNDAI_0x1
+	ecu.session.assume(kwp2000.enums.DiagnosticSession.FLASH_REPROGRAMMING, desired_baudrate.index, AccessLevel.HYUNDAI_0x1)
+
+	if args.desired_baudrate == 'auto':
+		print('[*] Looking for the fastest stable baudrate..')
+		desired_baudrate = negotiate_baudrate(ecu)
+		print('[*] Running at {} baud'.format(desired_baudrate.baudrate))
+
+	try:
+		if args.calibrate_timing:
+			print('[*] Calibrating timing parameters..')
+			timing = calibrate_timing(ecu)
+			print('[*] Using timing parameters {}'.format(timing) if timing else '[!] No timing parameters worked without errors, using the defaults')
+		elif apply_timing(ecu):
+			print('[*] Using the calibrated timing parameters')
+	except kwp2000.Kwp2000NegativeResponseException:
+		print('[!] Timing parameters not supported on this ECU!')
 
 	print('[*] Trying to find calibration..')
 	
@@ -294,7 +497,7 @@ def main(bus: kwp2000.Kwp2000Protocol, args):
 		description, calibration = ecu.get_calibration_description(), ecu.get_calibration()
 		print('[*] Found! Description: {}, calibration: {}'.format(description, calibration))
 	except kwp2000.Kwp2000NegativeResponseException:
-		if (input('[!] Failed! Do you want to continue? [y/n]: ') != 'y'):
+		if not confirm('[!] Failed! Do you want to continue? [y/n]: '):
 			return
 
 	if (args.immo):
@@ -302,7 +505,7 @@ def main(bus: kwp2000.Kwp2000Protocol, args):
 
 	if (args.id):
 		print('[*] Reading ECU Identification..',end='')
-		for parameter_key, parameter in fetch_ecu_identification(bus).items():
+		for parameter_key, parameter in ecu.fetch_identification().items():
 			value_dec = list(parameter['value'])
 			value_hex = ' '.join([hex(x) for x in value_dec])
 			value_ascii = strip(''.join([chr(x) for x in value_dec]))
@@ -316,39 +519,102 @@ def main(bus: kwp2000.Kwp2000Protocol, args):
 		cli_immo_info(ecu)
 
 	eeprom_size = ecu.get_eeprom_size_bytes()
+	# what didn't succeed, the rest still runs and it's summed up at the end
+	failures = []
 
 	if (args.read):
-		cli_read_eeprom(ecu, eeprom_size, address_start=args.address_start, address_stop=args.address_stop, escalate_privileges=True, output_filename=args.output)
+		if not cli_read_eeprom(ecu, eeprom_size, address_start=args.address_start, address_stop=args.address_stop, escalate_privileges=True, output_filename=args.output, bench=bench):
+			failures.append('read')
 	if (args.read_calibration):
-		cli_read_eeprom(ecu, eeprom_size, address_start=ecu.get_calibration_section_address(), address_stop=ecu.get_calibration_section_address()+ecu.get_calibration_size_bytes(), output_filename=args.output)
+		if not cli_read_eeprom(ecu, eeprom_size, address_start=ecu.get_calibration_section_address(), address_stop=ecu.get_calibration_section_address()+ecu.get_calibration_size_bytes(), output_filename=args.output, bench=bench):
+			failures.append('calibration read')
 	if (args.read_program):
 		address_start = ecu.get_program_section_address()
 		address_stop = address_start+ecu.get_program_section_size()
-		cli_read_eeprom(ecu, eeprom_size, address_start=address_start, address_stop=address_stop, output_filename=args.output)
+		if not cli_read_eeprom(ecu, eeprom_size, address_start=address_start, address_stop=address_stop, output_filename=args.output, bench=bench):
+			failures.append('program read')
 
 	if (args.flash):
-		cli_flash_eeprom(ecu, input_filename=args.flash)
+		if not cli_flash_eeprom(ecu, input_filename=args.flash, min_blank_gap=args.min_blank_gap, verify=args.verify, skip_unchanged=args.skip_unchanged, skip_unchanged_samples=args.skip_unchanged_samples):
+			failures.append('flash')
 	if (args.flash_calibration):
-		cli_flash_eeprom(ecu, input_filename=args.flash_calibration, flash_calibration=True, flash_program=False)
+		if not cli_flash_eeprom(ecu, input_filename=args.flash_calibration, flash_calibration=True, flash_program=False, min_blank_gap=args.min_blank_gap, verify=args.verify, skip_unchanged=args.skip_unchanged, skip_unchanged_samples=args.skip_unchanged_samples):
+			failures.append('calibration flash')
 	if (args.flash_program):
-		cli_flash_eeprom(ecu, input_filename=args.flash_program, flash_program=True, flash_calibration=False)
+		if not cli_flash_eeprom(ecu, input_filename=args.flash_program, flash_program=True, flash_calibration=False, min_blank_gap=args.min_blank_gap, verify=args.verify, skip_unchanged=args.skip_unchanged, skip_unchanged_samples=args.skip_unchanged_samples):
+			failures.append('program flash')
 
 	if (args.clear_adaptive_values):
 		cli_clear_adaptive_values(ecu)
 
 	if (args.logger):
-		logger(ecu)
+		logger(ecu, channels=args.channels)
+	if (args.logger_raw):
+		logger_raw(ecu, channels=args.channels)
+
+	logging.info('Retry counters: %s', get_retry_counters())
+	logging.info('Keepalive counters: %s', get_keepalive_counters(bus))
 
 	bus.close()
 
+	if failures:
+		print('[!] Finished, but the {} didn\'t succeed. See above'.format(', '.join(failures)))
+		raise OperationFailed('{} failed'.format(', '.join(failures)), ecu)
+	return ecu
+
 def packet2hex (packet: RawPacket) -> str:
 	direction = 'Incoming' if packet.direction == PacketDirection.INCOMING else 'Outgoing'
 	data = ' '.join([hex(x)[2:].zfill(2) for x in packet.data])
 	parsed = 'RawPacket({}, ts={}, data={})'.format(direction, packet.timestamp, data)
 	return parsed
 
+def cli_fleet (GKFlasher_config: dict, args) -> None:
+	global assume_yes, progress_enabled
+
+	if args.immo or args.logger or args.logger_raw:
+		print('[!] Immo and logger need someone at the keyboard, they can\'t run in fleet mode')
+		return
+
+	try:
+		benches = parse_fleet(args.fleet)
+	except ValueError as e:
+		print('[!] {}'.format(e))
+		return
+
+	if not args.yes and (args.flash or args.flash_calibration or args.flash_program):
+		if input('[?] Going to flash {} bench(es) without asking again. Continue? [y/n]: '.format(len(benches))) != 'y':
+			print('[!] Aborting!')
+			return
+
+	assume_yes, progress_enabled = True, False
+
+	def job (bench: Bench, result: BenchResult, stop: threading.Event) -> ECU:
+		if stop.is_set():
+			return None
+		bus = initialize_bus(bench.protocol, dict(GKFlasher_config[bench.protocol], interface=bench.interface))
+		meter = TrafficMeter(bus)
+		# on Ctrl+C the port is closed, whatever the bench is waiting for fails right away
+		threading.Thread(target=lambda: stop.wait() and bus.close(), name='{} stop'.format(bench.get_name()), daemon=True).start()
+		try:
+			return main(bus, args, bench=bench.get_name())
+		except OperationFailed as e:
+			raise JobFailed(str(e), ecu=e.ecu)
+		except Exception:
+			print('[*] Dumping buffer:\n')
+			print('\n'.join([packet2hex(packet) for packet in bus.transport.buffer_dump()]))
+			raise
+		finally:
+			result.transferred = meter.transferred
+			bus.close()
+
+	print('[*] Running on {} bench(es)..'.format(len(benches)))
+	results = run_fleet(benches, job)
+
+	print('\n' + format_summary(results))
+
 if __name__ == '__main__':
 	GKFlasher_config, args = load_arguments()
+	assume_yes = args.yes
 
 	print('[*] GKFlasher v{}'.format(__version__))
 
@@ -362,18 +628,32 @@ if __name__ == '__main__':
 	if (args.sie_to_bin):
 		generate_bin(filename=args.sie_to_bin)
 		sys.exit()
+
+	if (args.decode_log):
+		print('[*] Decoded to {}'.format(decode_raw_log(args.decode_log)))
+		sys.exit()
 	
+	if (args.fleet):
+		cli_fleet(GKFlasher_config, args)
+		sys.exit()
+
 	print('[*] Selected protocol: {}. Initializing..'.format(GKFlasher_config['protocol']))
 	bus = initialize_bus(GKFlasher_config['protocol'], GKFlasher_config[GKFlasher_config['protocol']])	
 
+	exit_code = 0
 	try:
 		main(bus, args)
 	except KeyboardInterrupt:
 		pass
+	except OperationFailed:
+		# already summed up by main
+		exit_code = 1
 	except Exception:
+		exit_code = 1
 		print('\n\n[!] Exception in main thread!')
 		print(traceback.format_exc())
 		print('[*] Dumping buffer:\n')
 		print('\n'.join([packet2hex(packet) for packet in bus.transport.buffer_dump()]))
 		print('\n[!] Shutting down due to an exception in the main thread. For exception details, see above')
 	bus.close()
+	sys.exit(exit_code)
@@ -1,5 +1,6 @@
 import os, sys
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 import plyer
 from PyQt5 import QtWidgets, uic
@@ -12,8 +13,9 @@ from gkbus.transport import Kwp2000OverKLineTransport, Kwp2000OverCanTransport,
 from gkbus.protocol import kwp2000
 from gkbus.protocol.kwp2000.commands import *
 from gkbus.protocol.kwp2000.enums import *
-from flasher.ecu import enable_security_access, fetch_ecu_identification, identify_ecu, ECUIdentificationException, ECU, DesiredBaudrate
-from flasher.memory import read_memory, write_memory, dynamic_find_end
+from flasher.ecu import enable_security_access, fetch_ecu_fingerprint, load_identification, save_identification, identify_ecu, verify_ecu, ECUIdentificationException, ECU, DesiredBaudrate
+from flasher.memory import read_memory, MappedDump, verify_written_pages, prepare_flash_plan, write_flash_plan
+from flasher.journal import PageJournal
 from flasher.checksum import *
 from flasher.immo import immo_status
 from ecu_definitions import ECU_IDENTIFICATION_TABLE, BAUDRATES, Routine, AccessLevel
@@ -21,6 +23,10 @@ from gkflasher import strip
 from _version import __version__
 from flasher.lineswap import generate_sie, generate_bin
 from flasher.smartra import calculate_smartra_pin
+from flasher.retry import get_retry_counters
+from flasher.keepalive import KeepalivePolicy, get_keepalive_counters
+from flasher.baudrate import negotiate_baudrate, start_session_at
+from flasher.timing import apply_timing
 
 #
 # @TODO: ... man, I don't even know. Start by separating this mess into controllers and views?
@@ -115,6 +121,8 @@ class Ui(QtWidgets.QMainWindow):
 		super(Ui, self).__init__()
 		self.load_ui()
 		self.previous_baudrate = False
+		# connection left open by the previous action, see initialize_ecu
+		self.pooled_ecu, self.pooled_key = None, None
 		self.log_signal.connect(self.log)  # Connect the signal to the `log` method
 
 		# Configure bsl logging for GUI
@@ -145,6 +153,7 @@ class Ui(QtWidgets.QMainWindow):
 		except:
 			print('[!] Buffer not found!')
 		print('\n[!] For exception details, see above.')
+		self.pooled_ecu = None
 		self.bus.close()
 
 	def load_ui(self):
@@ -250,6 +259,7 @@ class Ui(QtWidgets.QMainWindow):
 
 	def load_baudrates (self):
 		self.baudratesBox.addItem('Desired baudrate (default)', -1)
+		self.baudratesBox.addItem('Fastest stable (auto)', -2)
 		for index, baudrate in BAUDRATES.items():
 			self.baudratesBox.addItem('{} baud'.format(baudrate), index)
 
@@ -261,7 +271,8 @@ class Ui(QtWidgets.QMainWindow):
 
 	def get_desired_baudrate (self) -> DesiredBaudrate:
 		baudrate_index = self.baudratesBox.currentData()
-		if baudrate_index == -1:
+		if baudrate_index in (-1, -2):
+			# auto starts at the default too, see _initialize_ecu
 			# @todo: not ideal, but its a bridge towards moving this completely to the ECU class. it was a mess
 			return DesiredBaudrate(index=None, baudrate=10400)
 		return DesiredBaudrate(index=baudrate_index, baudrate=BAUDRATES[baudrate_index])
@@ -274,6 +285,7 @@ class Ui(QtWidgets.QMainWindow):
 			self.progressBar.setValue(self.progressBar.value()+value[0])
 
 	def _close_bus (self, log_callback) -> None:
+		self.pooled_ecu = None
 		if hasattr(self, 'bus'):
 			try:
 				self.bus.close()
@@ -296,24 +308,34 @@ class Ui(QtWidgets.QMainWindow):
 		transport = Kwp2000OverKLineTransport(hardware, tx_id=config['kline']['tx_id'], rx_id=config['kline']['rx_id'])
 
 		self.bus = kwp2000.Kwp2000Protocol(transport)
-		self.bus.init(StartCommunication(), keepalive_command=TesterPresent(ResponseType.REQUIRED), keepalive_delay=2)
+		self.bus.init(StartCommunication())
+		KeepalivePolicy(self.bus, TesterPresent(ResponseType.REQUIRED), delay=2).start()
 
-		if not self.get_desired_baudrate().index:
+		desired_baudrate = self.get_desired_baudrate()
+		if not desired_baudrate.index:
 			desired_baudrate = DesiredBaudrate(index=None, baudrate=10400)
 			log_callback.emit('[*] Trying to start diagnostic session')
 			self.bus.execute(StartDiagnosticSession(DiagnosticSession.FLASH_REPROGRAMMING))
 		else:
-			desired_baudrate = self.get_desired_baudrate()
 			log_callback.emit('[*] Trying to start diagnostic session with baudrate {}'.format(desired_baudrate.baudrate))
+			start_session_at(self.bus, desired_baudrate)
+
+		# cars seen before are recognized by fingerprint, so the identification doesn't have to be done again.
+		# it's read in the diagnostic session, not every ECU answers before it's started
+		fingerprint = fetch_ecu_fingerprint(self.bus)
+		known = load_identification(fingerprint)
+
+		if desired_baudrate.index:
+			save_identification(fingerprint, baudrate=desired_baudrate.index)
+		elif known.get('baudrate') in BAUDRATES and known['baudrate'] != 0x01 and self.baudratesBox.currentData() != -2:
+			log_callback.emit('[*] Known car, switching to the baudrate that worked last time ({})'.format(BAUDRATES[known['baudrate']]))
 			try:
-				self.bus.execute(StartDiagnosticSession(DiagnosticSession.FLASH_REPROGRAMMING, desired_baudrate.index))
-				self.bus.transport.hardware.set_baudrate(desired_baudrate.baudrate)
-			except TimeoutException:
-				# it's possible that the ecu is already running at the desired baudrate - let's check
-				self.bus.transport.hardware.socket.reset_input_buffer() # @todo: expose this in public gkbus api
-				self.bus.transport.hardware.socket.reset_output_buffer()
+				start_session_at(self.bus, DesiredBaudrate(index=known['baudrate'], baudrate=BAUDRATES[known['baudrate']]))
+				desired_baudrate = DesiredBaudrate(index=known['baudrate'], baudrate=BAUDRATES[known['baudrate']])
+			except (kwp2000.Kwp2000NegativeResponseException, TimeoutException):
+				log_callback.emit('[!] It doesn\'t work anymore, staying at 10400')
 				self.bus.transport.hardware.set_baudrate(desired_baudrate.baudrate)
-				self.bus.execute(StartDiagnosticSession(DiagnosticSession.FLASH_REPROGRAMMING, desired_baudrate.index))
+				self.bus.execute(StartDiagnosticSession(DiagnosticSession.FLASH_REPROGRAMMING))
 
 		self.bus.transport.hardware.set_timeout(12)
 
@@ -335,9 +357,14 @@ class Ui(QtWidgets.QMainWindow):
 		enable_security_access(self.bus)
 
 		log_callback.emit('[*] Trying to identify ECU.. ')
-		if self.ecusBox.currentData() == -1:
+		# the fingerprint doesn't change with a reflash, so the cached ECU is checked once before it's trusted
+		ecu = verify_ecu(self.bus, known['ecu']) if self.ecusBox.currentData() == -1 and known.get('ecu') else None
+		if ecu:
+			log_callback.emit('[*] Known car!')
+		elif self.ecusBox.currentData() == -1:
 			try:
 				ecu = identify_ecu(self.bus)
+				save_identification(fingerprint, ecu=ecu.get_name())
 			except ECUIdentificationException:
 				log_callback.emit('[*] Failed to identify ECU! Please select it from the dropdown and try again.')
 				return False
@@ -346,16 +373,62 @@ class Ui(QtWidgets.QMainWindow):
 			ecu.set_bus(self.bus)
 		
 		ecu.set_desired_baudrate(desired_baudrate)
+		ecu.set_fingerprint(fingerprint)
 		ecu.diagnostic_session_type = DiagnosticSession.FLASH_REPROGRAMMING
 		ecu.access_level = AccessLevel.HYUNDAI_0x1
+		ecu.session.assume(DiagnosticSession.FLASH_REPROGRAMMING, desired_baudrate.index, AccessLevel.HYUNDAI_0x1)
+
+		if self.baudratesBox.currentData() == -2:
+			log_callback.emit('[*] Looking for the fastest stable baudrate..')
+			desired_baudrate = negotiate_baudrate(ecu)
+			log_callback.emit('[*] Running at {} baud'.format(desired_baudrate.baudrate))
+
+		try:
+			if apply_timing(ecu):
+				log_callback.emit('[*] Using the calibrated timing parameters')
+		except kwp2000.Kwp2000NegativeResponseException:
+			pass
 
 		log_callback.emit('[*] Found! {}'.format(ecu.get_name()))
 		
 		return ecu
 
+	def _pool_key (self) -> tuple:
+		return (self.get_interface_url(), self.baudratesBox.currentData(), self.ecusBox.currentData())
+
+	def _reuse_ecu (self) -> ECU:
+		'''
+		The ECU left connected by the previous action, if the settings are the same
+		and it still answers TesterPresent. Otherwise None
+		'''
+		try:
+			if self.pooled_ecu is None or self.pooled_key != self._pool_key():
+				return None
+		except IndexError:
+			return None
+
+		hardware = self.pooled_ecu.bus.transport.hardware
+		try:
+			hardware.set_timeout(1)
+			self.pooled_ecu.bus.execute(TesterPresent(ResponseType.REQUIRED))
+			hardware.set_timeout(12)
+		except Exception as e:
+			logging.info('Pooled connection is gone, reconnecting: %s', e)
+			return None
+
+		return self.pooled_ecu
+
 	def initialize_ecu (self, log_callback) -> ECU:
+		ecu = self._reuse_ecu()
+		if ecu:
+			log_callback.emit('[*] Reusing the connection to {}'.format(ecu.get_name()))
+			return ecu
+
 		try:
-			return self._initialize_ecu(log_callback)
+			ecu = self._initialize_ecu(log_callback)
+			if ecu:
+				self.pooled_ecu, self.pooled_key = ecu, self._pool_key()
+			return ecu
 		except TimeoutException:
 			log_callback.emit('[*] Timeout! Try again. Maybe the ECU isn\'t connected properly?')
 		except Exception as e:
@@ -363,13 +436,31 @@ class Ui(QtWidgets.QMainWindow):
 
 		return False
 
-	def disconnect_ecu (self, ecu: ECU) -> None:
+	def disconnect_ecu (self, ecu: ECU, force: bool = False) -> None:
+		logging.info('Retry counters: %s', get_retry_counters())
+		logging.info('Keepalive counters: %s', get_keepalive_counters(ecu.bus))
+
+		# the connection is kept (and kept alive) for the next action,
+		# unless the ECU was reset and the session is gone anyway
+		if ecu is self.pooled_ecu and ecu.session.session is not None and not force:
+			return
+
+		if ecu is self.pooled_ecu:
+			self.pooled_ecu = None
 		try:
 			ecu.bus.execute(StopCommunication())
 		except (kwp2000.Kwp2000NegativeResponseException, TimeoutException, AttributeError):
 			pass
 		ecu.bus.close()
 
+	def release_pooled_ecu (self) -> None:
+		if self.pooled_ecu is not None:
+			self.disconnect_ecu(self.pooled_ecu, force=True)
+
+	def closeEvent (self, event):
+		self.release_pooled_ecu()
+		super(Ui, self).closeEvent(event)
+
 	def gui_read_eeprom (self, ecu: ECU, address_start: int = 0x000000, address_stop: int = None, escalate_privileges: bool = False, output_filename: str = None, log_callback=None, progress_callback=None):
 		eeprom_size = ecu.get_eeprom_size_bytes()
 
@@ -391,27 +482,40 @@ class Ui(QtWidgets.QMainWindow):
 
 		log_callback.emit('[*] Reading from {} to {}'.format(hex(address_start), hex(address_stop)))
 
-		requested_size = address_stop-address_start
-		eeprom = bytearray([0xFF]*eeprom_size)
-
-		fetched = read_memory(ecu, address_start=address_start, address_stop=address_stop, progress_callback=Progress(progress_callback, requested_size))
+		try:
+			calibration = ecu.get_calibration()
+		except (kwp2000.Kwp2000NegativeResponseException, TimeoutException):
+			calibration = None
 
-		eeprom_start = ecu.calculate_bin_offset(address_start)
-		eeprom_end = eeprom_start + len(fetched)
-		eeprom[eeprom_start:eeprom_end] = fetched
+		journal = PageJournal(PageJournal.filename(ecu.get_name(), calibration or 'unknown', address_start, address_stop))
+		if len(journal):
+			log_callback.emit('[*] Resuming an interrupted read, {} pages already fetched'.format(len(journal)))
 
 		if (output_filename == None):
 			try:
-				calibration = ecu.get_calibration()
+				if calibration is None:
+					raise ValueError('calibration unknown')
 				description = ecu.get_calibration_description()
-				hw_rev_c = strip(''.join([chr(x) for x in list(ecu.bus.execute(ReadEcuIdentification(0x8c)).get_data())[1:]]))
-				hw_rev_d = strip(''.join([chr(x) for x in list(ecu.bus.execute(ReadEcuIdentification(0x8d)).get_data())[1:]]))
+				hw_rev_c = strip(''.join([chr(x) for x in ecu.get_identification(0x8c)]))
+				hw_rev_d = strip(''.join([chr(x) for x in ecu.get_identification(0x8d)]))
 				output_filename = "{}_{}_{}_{}_{}.bin".format(description, calibration, hw_rev_c, hw_rev_d, datetime.now().strftime('%Y-%m-%d_%H%M'))
 			except: # dirty
 				output_filename = "output_{}_to_{}.bin".format(hex(address_start), hex(address_stop))
-		
-		with open(output_filename, "wb") as file:
-			file.write(bytes(eeprom))
+
+		requested_size = address_stop-address_start
+		eeprom_start = ecu.calculate_bin_offset(address_start)
+		eeprom_end = eeprom_start + requested_size
+
+		# the dump is written in place as pages come in
+		dump = MappedDump(output_filename, max(eeprom_size, eeprom_end))
+		with dump as eeprom, eeprom[eeprom_start:eeprom_end] as buffer:
+			result = read_memory(ecu, address_start=address_start, address_stop=address_stop, progress_callback=Progress(progress_callback, requested_size), journal=journal, buffer=buffer)
+			if result.interrupted:
+				dump.discard()
+
+		if result.interrupted:
+			log_callback.emit('[!] Read interrupted! {} pages are saved, read again to resume.'.format(len(journal)))
+			return
 
 		# Display user friendly path based on OS
 		if os.name == 'nt':
@@ -419,57 +523,97 @@ class Ui(QtWidgets.QMainWindow):
 		else: # nix
 			log_callback.emit('[*] saved to {}'.format(home + "/" + output_filename))
 
+		if result.restricted_ranges:
+			log_callback.emit('[*] {} restricted range(s) are filled with 0xFF:'.format(len(result.restricted_ranges)))
+			for restricted_start, restricted_stop in result.restricted_ranges:
+				log_callback.emit('    {} - {}'.format(hex(restricted_start), hex(restricted_stop)))
+
+		if result.failed_ranges:
+			log_callback.emit('[!] {} range(s) couldn\'t be read and are filled with 0xFF:'.format(len(result.failed_ranges)))
+			for failed_start, failed_stop in result.failed_ranges:
+				log_callback.emit('    {} - {}'.format(hex(failed_start), hex(failed_stop)))
+			log_callback.emit('    Read again to retry just the affected pages.')
+		else:
+			journal.remove()
+
 		log_callback.emit('[*] Done!')
 		self.send_notification('Reading finished', 'Saved to {}'.format(home + "\\" + output_filename))
 
-	def gui_flash_eeprom (self, ecu: ECU, input_filename: str, flash_calibration: bool = True, flash_program: bool = True, log_callback=None, progress_callback=None):
+	def gui_verify_zone (self, ecu: ECU, payload, flash_start: int, read_start: int, page_hashes: dict, log_callback=None, progress_callback=None) -> bool:
+		verify_size = sum(page_stop-page_start for page_start, page_stop in page_hashes)
+		log_callback.emit('[*] Reading back {} bytes to verify'.format(verify_size))
+
+		result = verify_written_pages(ecu, payload, flash_start, read_start, page_hashes, progress_callback=Progress(progress_callback, verify_size))
+
+		for rewritten_start, rewritten_stop in result.rewritten_ranges:
+			log_callback.emit('[*] Rewrote {} - {}'.format(hex(read_start+rewritten_start), hex(read_start+rewritten_stop)))
+
+		if not result.success():
+			log_callback.emit('[!] {} range(s) don\'t match the file:'.format(len(result.mismatched_ranges)))
+			for mismatched_start, mismatched_stop in result.mismatched_ranges:
+				log_callback.emit('    {} - {}'.format(hex(read_start+mismatched_start), hex(read_start+mismatched_stop)))
+			log_callback.emit('    Flash the zone again.')
+			return False
+
+		log_callback.emit('[*] Verified!')
+		return True
+
+	def gui_flash_eeprom (self, ecu: ECU, input_filename: str, flash_calibration: bool = True, flash_program: bool = True, verify: bool = False, log_callback=None, progress_callback=None):
 		log_callback.emit('[*] Loading up {}'.format(input_filename))
 
 		try:
 			with open(input_filename, 'rb') as file:
-				eeprom = file.read()
+				eeprom = memoryview(file.read()) # zone payloads are sliced out as views, not copies
 			log_callback.emit('[*] Loaded {} bytes'.format(len(eeprom)))
 		except FileNotFoundError:
 			log_callback.emit('[!] Error: File not found.')
 			return self.disconnect_ecu(ecu)
 
-		if flash_program:
-			log_callback.emit('[*] start routine 0x00 (erase program code section)')
-			ecu.bus.execute(StartRoutineByLocalIdentifier(Routine.ERASE_PROGRAM.value))
+		# packets are built in the background while the ECU is busy erasing
+		with ThreadPoolExecutor(max_workers=1) as executor:
+			if flash_program:
+				# we need to start 16 bytes later as the program section starts with a flag that we can't write
+				payload_start = ecu.calculate_bin_offset(ecu.get_program_section_address()) + 16
+				program_plan = executor.submit(prepare_flash_plan, eeprom[payload_start:(payload_start+ecu.get_program_section_size()-16)], ecu.get_program_section_address() + 16, verify=verify)
+
+			if flash_calibration:
+				payload_start = ecu.calculate_bin_offset(ecu.get_calibration_section_address())
+				# we need to shave 16 bytes off the top as this is where a flag that we can't write is located
+				calibration_plan = executor.submit(prepare_flash_plan, eeprom[payload_start:(payload_start+ecu.get_calibration_size_bytes()-16)], ecu.calculate_memory_write_offset(ecu.get_calibration_section_address()), verify=verify)
 
-			# we need to start 16 bytes later as the program section starts with a flag that we can't write
-			payload_start = ecu.calculate_bin_offset(ecu.get_program_section_address()) + 16
-			payload_stop = payload_start + dynamic_find_end(eeprom[payload_start:(payload_start+ecu.get_program_section_size()-16)])
-			payload = eeprom[payload_start:payload_stop]
+			ecu.session.require(ecu.get_diagnostic_session_type(), access_level=AccessLevel.HYUNDAI_0x1)
 
-			if payload_stop == payload_start:
-				log_callback.emit('[!!!] Adjusted payload has a length of 0. This most probably means you\'re trying to flash an empty file, or trying to flash a zone from a file that doesn\'t have it.')
+			if flash_program:
+				log_callback.emit('[*] start routine 0x00 (erase program code section)')
+				ecu.bus.execute(StartRoutineByLocalIdentifier(Routine.ERASE_PROGRAM.value))
 
-			flash_start = ecu.get_program_section_address() + 16
-			flash_size = payload_stop-payload_start
+				plan = program_plan.result()
+				if len(plan.payload) == 0:
+					log_callback.emit('[!!!] Adjusted payload has a length of 0. This most probably means you\'re trying to flash an empty file, or trying to flash a zone from a file that doesn\'t have it.')
 
-			log_callback.emit('[*] Uploading data to the ECU')
-			write_memory(ecu, payload, flash_start, flash_size, progress_callback=Progress(progress_callback, flash_size))
+				log_callback.emit('[*] Uploading {} of {} bytes to the ECU in {} segment(s)'.format(plan.flash_size(), len(plan.payload), len(plan.segments)))
+				write_flash_plan(ecu, plan, progress_callback=Progress(progress_callback, plan.flash_size()))
 
-		if flash_calibration:
-			log_callback.emit('[*] start routine 0x01 (erase calibration section)')
-			ecu.bus.execute(StartRoutineByLocalIdentifier(Routine.ERASE_CALIBRATION.value))
+				if verify:
+					self.gui_verify_zone(ecu, plan.payload, plan.flash_start, plan.flash_start, plan.page_hashes, log_callback=log_callback, progress_callback=progress_callback)
 
-			payload_start = ecu.calculate_bin_offset(ecu.get_calibration_section_address())
-			# we need to shave 16 bytes off the top as this is where a flag that we can't write is located
-			payload_stop = payload_start + dynamic_find_end(eeprom[payload_start:(payload_start+ecu.get_calibration_size_bytes()-16)])
-			payload = eeprom[payload_start:payload_stop]
+			if flash_calibration:
+				log_callback.emit('[*] start routine 0x01 (erase calibration section)')
+				ecu.bus.execute(StartRoutineByLocalIdentifier(Routine.ERASE_CALIBRATION.value))
 
-			if payload_stop == payload_start:
-				log_callback.emit('[!!!] Adjusted payload has a length of 0. This most probably means you\'re trying to flash an empty file, or trying to flash a zone from a file that doesn\'t have it.')
+				plan = calibration_plan.result()
+				if len(plan.payload) == 0:
+					log_callback.emit('[!!!] Adjusted payload has a length of 0. This most probably means you\'re trying to flash an empty file, or trying to flash a zone from a file that doesn\'t have it.')
 
-			flash_start = ecu.calculate_memory_write_offset(ecu.get_calibration_section_address())
-			flash_size = payload_stop-payload_start
+				log_callback.emit('[*] Uploading {} of {} bytes to the ECU in {} segment(s)'.format(plan.flash_size(), len(plan.payload), len(plan.segments)))
+				write_flash_plan(ecu, plan, progress_callback=Progress(progress_callback, plan.flash_size()))
 
-			log_callback.emit('[*] Uploading data to the ECU')
-			write_memory(ecu, payload, flash_start, flash_size, progress_callback=Progress(progress_callback, flash_size))
+				if verify:
+					# the calibration zone is written through a different address than it's read from
+					self.gui_verify_zone(ecu, plan.payload, plan.flash_start, ecu.get_calibration_section_address(), plan.page_hashes, log_callback=log_callback, progress_callback=progress_callback)
 
 		progress_callback.emit((99, 100))
+		ecu.forget_identification()
 
 		ecu.bus.transport.hardware.set_timeout(300)
 		log_callback.emit('[*] start routine 0x02 (verify blocks and mark as ready to execute)')
@@ -493,6 +637,7 @@ class Ui(QtWidgets.QMainWindow):
 			ecu.bus.execute(ECUReset(ResetMode.POWER_ON_RESET))
 		except TimeoutException: 
 			pass # response is not guaranteed
+		ecu.session.invalidate()
 
 	def read_calibration_zone (self, progress_callback, log_callback):
 		ecu = self.initialize_ecu(log_callback)
@@ -562,7 +707,7 @@ class Ui(QtWidgets.QMainWindow):
 
 		log_callback.emit('[*] Querying additional parameters,  this might take a few seconds..')
 
-		for parameter_key, parameter in fetch_ecu_identification(ecu.bus).items():
+		for parameter_key, parameter in ecu.fetch_identification().items():
 			value_dec = list(parameter['value'])
 			value_hex = ' '.join([hex(x) for x in value_dec])
 			value_ascii = strip(''.join([chr(x) for x in value_dec]))
@@ -573,7 +718,7 @@ class Ui(QtWidgets.QMainWindow):
 			log_callback.emit('            [ASCII]: {}'.format(value_ascii))
 			log_callback.emit('')
 
-		ecu.bus.execute(StartDiagnosticSession(DiagnosticSession.DEFAULT, ecu.get_desired_baudrate().index))
+		ecu.session.require(DiagnosticSession.DEFAULT)
 		try:
 			immo_data = ecu.bus.execute(StartRoutineByLocalIdentifier(Routine.QUERY_IMMO_INFO.value)).get_data()
 		except kwp2000.Kwp2000NegativeResponseException as e:
@@ -691,7 +836,7 @@ class Ui(QtWidgets.QMainWindow):
 			return
 
 		filename = self.flashingFileInput.text()
-		self.gui_flash_eeprom(ecu, input_filename=filename, flash_calibration=True, flash_program=False, log_callback=log_callback, progress_callback=progress_callback)
+		self.gui_flash_eeprom(ecu, input_filename=filename, flash_calibration=True, flash_program=False, verify=self.flashingVerifyCheckbox.isChecked(), log_callback=log_callback, progress_callback=progress_callback)
 		self.disconnect_ecu(ecu)
 
 	def flash_program (self, progress_callback, log_callback):
@@ -702,7 +847,7 @@ class Ui(QtWidgets.QMainWindow):
 			return
 
 		filename = self.flashingFileInput.text()
-		self.gui_flash_eeprom(ecu, input_filename=filename, flash_calibration=False, flash_program=True, log_callback=log_callback, progress_callback=progress_callback)
+		self.gui_flash_eeprom(ecu, input_filename=filename, flash_calibration=False, flash_program=True, verify=self.flashingVerifyCheckbox.isChecked(), log_callback=log_callback, progress_callback=progress_callback)
 		self.disconnect_ecu(ecu)
 
 	def flash_full (self, progress_callback, log_callback):
@@ -713,7 +858,7 @@ class Ui(QtWidgets.QMainWindow):
 			return
 
 		filename = self.flashingFileInput.text()
-		self.gui_flash_eeprom(ecu, input_filename=filename, flash_calibration=True, flash_program=True, log_callback=log_callback, progress_callback=progress_callback)
+		self.gui_flash_eeprom(ecu, input_filename=filename, flash_calibration=True, flash_program=True, verify=self.flashingVerifyCheckbox.isChecked(), log_callback=log_callback, progress_callback=progress_callback)
 		self.disconnect_ecu(ecu)
 
 	def clear_adaptive_values (self, progress_callback, log_callback):
@@ -737,7 +882,7 @@ class Ui(QtWidgets.QMainWindow):
 		
 		log_callback.emit('[*] Querying additional parameters,  this might take a few seconds..')
 
-		ecu.bus.execute(StartDiagnosticSession(DiagnosticSession.DEFAULT, ecu.get_desired_baudrate().index))
+		ecu.session.require(DiagnosticSession.DEFAULT)
 		
 		try:
 			immo_data = ecu.bus.execute(StartRoutineByLocalIdentifier(Routine.QUERY_IMMO_INFO.value)).get_data()
@@ -764,7 +909,7 @@ class Ui(QtWidgets.QMainWindow):
 			return
 
 		log_callback.emit('[*] Starting default diagnostic session...')
-		ecu.bus.execute(StartDiagnosticSession(DiagnosticSession.DEFAULT, ecu.get_desired_baudrate().index))
+		ecu.session.require(DiagnosticSession.DEFAULT)
 
 		log_callback.emit('[*] Checking Immobilizer status...')
 		try:
@@ -826,7 +971,7 @@ class Ui(QtWidgets.QMainWindow):
 			return
 		
 		log_callback.emit('[*] Starting default diagnostic session...')
-		ecu.bus.execute(StartDiagnosticSession(DiagnosticSession.DEFAULT, ecu.get_desired_baudrate().index))
+		ecu.session.require(DiagnosticSession.DEFAULT)
 
 		# Check the ECU status
 		try:
@@ -885,7 +1030,7 @@ class Ui(QtWidgets.QMainWindow):
 			return
 
 		log_callback.emit('[*] Starting default diagnostic session...')
-		ecu.bus.execute(StartDiagnosticSession(DiagnosticSession.DEFAULT, ecu.get_desired_baudrate().index))
+		ecu.session.require(DiagnosticSession.DEFAULT)
 
 		log_callback.emit('[*] Starting SMARTRA neutralization...')
 		# Check the ECU status with BEFORE_SMARTRA_NEUTRALIZE
@@ -955,7 +1100,7 @@ class Ui(QtWidgets.QMainWindow):
 			return
 
 		log_callback.emit('[*] Starting default diagnostic session...')
-		ecu.bus.execute(StartDiagnosticSession(DiagnosticSession.DEFAULT, ecu.get_desired_baudrate().index))
+		ecu.session.require(DiagnosticSession.DEFAULT)
 
 		log_callback.emit('[*] Teaching immobilizer keys...')
 		#log_callback.emit('[*] starting routine 0x14')
@@ -1040,7 +1185,7 @@ class Ui(QtWidgets.QMainWindow):
 		log_callback.emit('[*] Starting limp home password teaching...')
 		
 		log_callback.emit('[*] Starting default diagnostic session...')
-		ecu.bus.execute(StartDiagnosticSession(DiagnosticSession.DEFAULT, ecu.get_desired_baudrate().index))
+		ecu.session.require(DiagnosticSession.DEFAULT)
 
 		# Check ECU status
 		try:
@@ -1128,7 +1273,7 @@ class Ui(QtWidgets.QMainWindow):
 			return
 
 		log_callback.emit('[*] Starting default diagnostic session...')
-		ecu.bus.execute(StartDiagnosticSession(DiagnosticSession.DEFAULT, ecu.get_desired_baudrate().index))
+		ecu.session.require(DiagnosticSession.DEFAULT)
 
 		try:
 			cmd = kwp2000.Kwp2000Command()
@@ -1151,7 +1296,7 @@ class Ui(QtWidgets.QMainWindow):
 			return
 		
 		log_callback.emit('[*] Starting default diagnostic session...')
-		ecu.bus.execute(StartDiagnosticSession(DiagnosticSession.DEFAULT, ecu.get_desired_baudrate().index))
+		ecu.session.require(DiagnosticSession.DEFAULT)
 
 		log_callback.emit('[*] Starting VIN writing process...')
 
@@ -1254,6 +1399,7 @@ class Ui(QtWidgets.QMainWindow):
 		return user_file_path
 
 	def bslHwInfo(self, progress_callback=None, log_callback=None, log_callback2=None):
+		self.release_pooled_ecu() # BSL needs the interface for itself
 		try:		
 			# BSL arguments
 			args = [
@@ -1267,6 +1413,7 @@ class Ui(QtWidgets.QMainWindow):
 			log_callback.emit(f"An error occurred: {str(e)}")
 
 	def bslReadIntRom(self, progress_callback=None, log_callback=None, log_callback2=None):
+		self.release_pooled_ecu() # BSL needs the interface for itself
 		try:
 			# Retrieve the file path from the QLineEdit
 			user_file_path = self.get_or_generate_file_path()
@@ -1288,6 +1435,7 @@ class Ui(QtWidgets.QMainWindow):
 			log_callback.emit(f"An error occurred: {str(e)}")
 
 	def bslReadExtFlash(self, progress_callback=None, log_callback=None, log_callback2=None):
+		self.release_pooled_ecu() # BSL needs the interface for itself
 		try:
 			# Retrieve the file path from the QLineEdit
 			user_file_path = self.get_or_generate_file_path()
@@ -1307,6 +1455,7 @@ class Ui(QtWidgets.QMainWindow):
 			log_callback.emit(f"An error occurred: {str(e)}")
 
 	def bslWriteExtFlash(self, progress_callback=None, log_callback=None, log_callback2=None):
+		self.release_pooled_ecu() # BSL needs the interface for itself
 		try:
 			# Retrieve the file path from the QLineEdit
 			user_file_path = self.get_or_generate_file_path()